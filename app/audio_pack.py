@@ -0,0 +1,182 @@
+# app/audio_pack.py
+"""
+Предсинтезированная озвучка словаря Wasabi (CSV в app/docs).
+
+Офлайн-сборка: каждая японская запись CSV озвучивается один раз каждым голосом из
+SPEAKER_VOICES и складывается в пак:
+  pack_<fmt>.bin       — все аудио подряд (один файл)
+  pack_<fmt>.idx.json  — {"format": fmt, "entries": {voice: {text: [offset, length]}}}
+
+В рантайме .bin открывается через mmap, tts.fetch_dialogue_audio берёт короткие реплики
+из пака и ходит в живой TTS только за тем, чего в паке нет.
+
+Сборка (из app/):
+  python audio_pack.py build              # формат = TTS_OUTPUT_FORMAT
+  python audio_pack.py build --format pcm
+  python audio_pack.py stats
+"""
+import argparse
+import csv
+import json
+import mmap
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import AUDIO_PACK_DIR, DOCS_DIR, TTS_OUTPUT_FORMAT
+
+
+RE_JAPANESE = re.compile(r"[぀-ヿ㐀-䶿一-鿿々〆ー]")
+# колонки с японским текстом, если у CSV есть заголовок
+JP_COLUMNS = {"kanji", "word", "kana", "japanese", "jp", "reading", "кандзи", "слово", "кана"}
+
+
+def _blob_path(fmt: str, base: Path = AUDIO_PACK_DIR) -> Path:
+    return base / f"pack_{fmt}.bin"
+
+
+def _index_path(fmt: str, base: Path = AUDIO_PACK_DIR) -> Path:
+    return base / f"pack_{fmt}.idx.json"
+
+
+class AudioPack:
+    """Только чтение: индекс в памяти, аудио — срезами из mmap."""
+
+    def __init__(self, fmt: str, base: Path = AUDIO_PACK_DIR):
+        self.fmt = fmt
+        self.entries: Dict[str, Dict[str, List[int]]] = {}
+        self._mm: Optional[mmap.mmap] = None
+        self._fh = None
+
+        idx, blob = _index_path(fmt, base), _blob_path(fmt, base)
+        if not idx.exists() or not blob.exists() or blob.stat().st_size == 0:
+            return
+        meta = json.loads(idx.read_text(encoding="utf-8"))
+        if meta.get("format") != fmt:
+            return
+        self.entries = meta.get("entries") or {}
+        self._fh = open(blob, "rb")
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self.entries.values())
+
+    def get(self, voice: str, text: str) -> Optional[bytes]:
+        if self._mm is None:
+            return None
+        loc = self.entries.get(voice, {}).get(text)
+        if loc is None:
+            return None
+        offset, length = loc
+        return self._mm[offset:offset + length]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+_packs: Dict[str, AudioPack] = {}
+_packs_lock = threading.Lock()
+
+
+def get_pack(fmt: str) -> AudioPack:
+    """Пак формата fmt; открывается один раз на процесс (пустой, если пак не собран)."""
+    with _packs_lock:
+        pack = _packs.get(fmt)
+        if pack is None:
+            pack = _packs[fmt] = AudioPack(fmt)
+        return pack
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Офлайн-сборка
+# ─────────────────────────────────────────────────────────────────────────────
+def _csv_rows(path: Path) -> Iterable[List[str]]:
+    text = path.read_text(encoding="utf-8-sig")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return csv.reader(text.splitlines(), dialect)
+
+
+def iter_csv_vocabulary(docs_dir: Path = DOCS_DIR) -> List[str]:
+    """
+    Японские записи из CSV: колонки kanji/word/kana (если есть заголовок),
+    иначе — любые ячейки с японскими символами.
+    """
+    items: List[str] = []
+    for path in sorted(docs_dir.glob("*.csv")):
+        rows = list(_csv_rows(path))
+        if not rows:
+            continue
+        header = [c.strip().lower() for c in rows[0]]
+        cols = [i for i, name in enumerate(header) if name in JP_COLUMNS]
+        body = rows[1:] if cols else rows
+        for row in body:
+            cells = [row[i] for i in cols if i < len(row)] if cols else row
+            items.extend(c.strip() for c in cells if RE_JAPANESE.search(c or ""))
+    return items
+
+
+def build_pack(fmt: str, docs_dir: Path = DOCS_DIR, base: Path = AUDIO_PACK_DIR) -> Tuple[int, int]:
+    """
+    Собирает пак заново; уже озвученные в старом паке записи переиспользуются без TTS.
+    Возвращает (всего записей, из них синтезировано сейчас).
+    """
+    from tts import SPEAKER_VOICES, prepare_tts_text, _speech_bytes
+
+    texts = sorted({t for t in (prepare_tts_text(x) for x in iter_csv_vocabulary(docs_dir)) if t})
+    voices = sorted(set(SPEAKER_VOICES.values()))
+    old = AudioPack(fmt, base)
+
+    base.mkdir(parents=True, exist_ok=True)
+    blob_tmp = _blob_path(fmt, base).with_suffix(".bin.tmp")
+    entries: Dict[str, Dict[str, List[int]]] = {v: {} for v in voices}
+    synthesized = 0
+    offset = 0
+    with blob_tmp.open("wb") as out:
+        for voice in voices:
+            for text in texts:
+                data = old.get(voice, text)
+                if data is None:
+                    data = _speech_bytes(voice, text, fmt)
+                    synthesized += 1
+                out.write(data)
+                entries[voice][text] = [offset, len(data)]
+                offset += len(data)
+    old.close()
+
+    idx_tmp = _index_path(fmt, base).with_suffix(".json.tmp")
+    idx_tmp.write_text(json.dumps({"format": fmt, "entries": entries}, ensure_ascii=False), encoding="utf-8")
+    blob_tmp.replace(_blob_path(fmt, base))
+    idx_tmp.replace(_index_path(fmt, base))
+    return len(texts) * len(voices), synthesized
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пак озвучки словаря Wasabi")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build")
+    p_build.add_argument("--format", default=TTS_OUTPUT_FORMAT, choices=["mp3", "opus", "pcm"])
+    p_stats = sub.add_parser("stats")
+    p_stats.add_argument("--format", default=TTS_OUTPUT_FORMAT, choices=["mp3", "opus", "pcm"])
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        total, synthesized = build_pack(args.format)
+        print(f"pack_{args.format}: {total} entries ({synthesized} synthesized, {total - synthesized} reused)")
+    elif args.cmd == "stats":
+        pack = AudioPack(args.format)
+        blob = _blob_path(args.format)
+        size = blob.stat().st_size if blob.exists() else 0
+        print(f"pack_{args.format}: {len(pack)} entries, {size / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# app/bench_audio.py
+"""
+Сравнение форматов аудирования: MP3 (pydub) против OGG/Opus (голосовое).
+
+Для каждого варианта меряем отдельно:
+  - tts_s      — получение реплик от TTS (сеть + синтез),
+  - encode_s   — сборка итогового файла (склейка/кодирование/ремукс),
+  - bytes      — размер итогового файла,
+  - deliver_s  — отправка в Telegram (только с --chat-id).
+
+Запуск (из app/):
+  python bench_audio.py
+  python bench_audio.py --script dialog.txt --repeat 3 --chat-id 123456
+"""
+import argparse
+import asyncio
+import os
+import time
+from pathlib import Path
+from statistics import median
+from typing import Dict, List
+
+from config import TELEGRAM_BOT_TOKEN
+from textproc import parse_script
+from tts import fetch_dialogue_audio, assemble_mp3, assemble_ogg_from_pcm, assemble_ogg_from_opus
+
+
+SAMPLE_SCRIPT = """A: すみません、駅はどこですか。
+B: まっすぐ行って、二つ目の角を右に曲がってください。
+A: 歩いて何分ぐらいかかりますか。
+B: 十分ぐらいです。
+A: ありがとうございます。"""
+
+VARIANTS = {
+    # name: (формат TTS, функция сборки)
+    "mp3": ("mp3", assemble_mp3),
+    "ogg<-pcm": ("pcm", assemble_ogg_from_pcm),
+    "ogg<-opus": ("opus", assemble_ogg_from_opus),
+}
+
+
+async def _deliver(path: Path, chat_id: int) -> float:
+    from telegram import Bot
+    from sender import TelegramSender
+
+    sender = TelegramSender()
+    async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+        t0 = time.perf_counter()
+        await sender.send_dialogue_audio(bot, chat_id, path, title=f"bench {path.suffix}")
+        return time.perf_counter() - t0
+
+
+def run_bench(script: str, repeat: int, chat_id: int | None) -> Dict[str, Dict[str, float]]:
+    dialogue = parse_script(script)
+    results: Dict[str, Dict[str, float]] = {}
+    for name, (fmt, assemble) in VARIANTS.items():
+        tts_s: List[float] = []
+        encode_s: List[float] = []
+        size = 0
+        deliver_s: List[float] = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            chunks = fetch_dialogue_audio(dialogue, fmt)
+            t1 = time.perf_counter()
+            path = assemble(chunks)
+            t2 = time.perf_counter()
+            tts_s.append(t1 - t0)
+            encode_s.append(t2 - t1)
+            size = path.stat().st_size
+            if chat_id:
+                deliver_s.append(asyncio.run(_deliver(path, chat_id)))
+            os.remove(path)
+        results[name] = {
+            "tts_s": median(tts_s),
+            "encode_s": median(encode_s),
+            "bytes": size,
+            "deliver_s": median(deliver_s) if deliver_s else float("nan"),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MP3 vs OGG/Opus для аудирования")
+    parser.add_argument("--script", type=Path, help="файл с диалогом A:/B:")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--chat-id", type=int, default=None, help="куда слать для замера доставки")
+    args = parser.parse_args()
+
+    script = args.script.read_text(encoding="utf-8") if args.script else SAMPLE_SCRIPT
+    results = run_bench(script, args.repeat, args.chat_id)
+
+    print(f"{'variant':<10} {'tts_s':>8} {'encode_s':>9} {'bytes':>9} {'deliver_s':>10}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['tts_s']:>8.2f} {r['encode_s']:>9.3f} {r['bytes']:>9} {r['deliver_s']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
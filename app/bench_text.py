@@ -0,0 +1,261 @@
+# app/bench_text.py
+"""
+Сверка и микробенчмарк textproc.py против прежних реализаций (копии ниже, как они были
+в main.py / tts.py до переноса).
+
+  golden — на корпусе (живые примеры + детерминированный фаззинг) новые функции обязаны
+           давать ровно тот же результат, что и старые; расхождения печатаются, код выхода 1;
+  bench  — время на вызов, старое и новое, и ускорение.
+
+Запуск (из app/):
+  python bench_text.py
+  python bench_text.py --fuzz 5000 --repeat 200
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from statistics import median
+from typing import Callable, Dict, List, Tuple
+
+import textproc
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Прежние реализации (эталон)
+# ─────────────────────────────────────────────────────────────────────────────
+def legacy_prepare_tts_text(text: str) -> str:
+    if not text:
+        return ""
+    t = text
+    t = re.split(r"\s+—\s+|\s+-\s+", t, maxsplit=1)[0]
+    t = re.sub(r"\([^)]*\)", "", t)
+    t = re.sub(r"（[^）]*）", "", t)
+    t = re.sub(r"[A-Za-zА-Яа-яЁё]", "", t)
+    t = re.sub(r"\s{2,}", " ", t).strip()
+    return t
+
+
+def legacy_normalize_speaker_label(s: str) -> str:
+    if not s:
+        return ""
+    s = s.strip()
+    repl = {"А": "A", "В": "B", "С": "C", "а": "A", "в": "B", "с": "C"}
+    c = repl.get(s[0], s[0])
+    return c.upper()
+
+
+def legacy_script_to_dialogue_list(script: str) -> List[Dict[str, str]]:
+    dialogue = []
+    for raw in script.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        parts = re.split(r"\s*[:：]\s*", line, maxsplit=1)
+        if len(parts) == 2 and parts[0]:
+            sp, jp = parts[0].strip(), parts[1].strip()
+        else:
+            sp, jp = "", line
+        dialogue.append({"speaker": sp, "jp": jp})
+    return dialogue
+
+
+def legacy_strip_dialogue_from_student(text: str) -> str:
+    if not text:
+        return text
+    t = re.sub(r"```(?:audio|jp-audio|audio-script)\s*[\s\S]*?```", "", text, flags=re.IGNORECASE)
+    t = re.compile(r"^(?:[A-ZА-ЯЁ]{1,2}\s*:\s*.+)$", re.MULTILINE).sub("", t)
+    t = re.sub(r"\n{3,}", "\n\n", t).strip()
+    return t
+
+
+def legacy_repair_common_json_glitches(raw: str) -> str:
+    s = raw
+    s = re.sub(r'("audio_script"\s*:\s*"(?:[^"\\]|\\.)*")\s*\]\s*,', r'\1,', s, flags=re.DOTALL)
+    s = re.sub(r',\s*}', r'}', s)
+    return s
+
+
+def legacy_extract_json_objects(raw: str):
+    objs = []
+    depth = 0
+    start = None
+    in_str = False
+    esc = False
+    for i, ch in enumerate(raw):
+        if depth == 0:
+            if ch == '{':
+                depth = 1
+                start = i
+        else:
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == '\\':
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            else:
+                if ch == '"':
+                    in_str = True
+                elif ch == '{':
+                    depth += 1
+                elif ch == '}':
+                    depth -= 1
+                    if depth == 0 and start is not None:
+                        objs.append(raw[start:i+1])
+                        start = None
+    return objs
+
+
+def legacy_iter_tts_lines(dialogue: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    lines = []
+    for turn in dialogue:
+        sp = (turn.get("speaker") or "").strip()
+        jp = (turn.get("jp") or "").strip()
+        if not jp:
+            continue
+        clean_text = legacy_prepare_tts_text(jp)
+        if not clean_text:
+            continue
+        lines.append((legacy_normalize_speaker_label(sp), clean_text))
+    return lines
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Корпус
+# ─────────────────────────────────────────────────────────────────────────────
+SAMPLE_SCRIPT = """A: すみません、駅はどこですか。 — Извините, где станция?
+B：まっすぐ行って、二つ目の角を右に曲がってください。(прямо и направо)
+А: 歩いて何分ぐらいかかりますか。（あるいて）
+В:  十分ぐらいです - минут десять
+ありがとうございます。
+: пустая метка
+C:"""
+
+SAMPLE_REPLY = (
+    'Вот задание:\n{"Student": "Послушай диалог\\nи ответь \\"кто\\" куда идёт {важно}", '
+    '"Bot": {"level": "N5", "score": 120, "audio_script": "A: こんにちは\\nB: こんにちは"], '
+    '"stats": [{"level": "N5", "type": "аудирование", "title": "t", "tries": 1, "successes": 1, "comments": "",}]}}\n'
+    '{"Student": "второй", "Bot": {"level": "N4", "score": 1, "audio_script": "", "stats": []}} хвост {незакрыт'
+)
+
+# типичный ответ модели: длинное объяснение в Student — основная масса символов внутри строк
+LONG_REPLY = json.dumps({
+    "Student": "Разберём частицы は и が: は отмечает тему, が — подлежащее. " * 40,
+    "Bot": {"level": "N5", "score": 120, "audio_script": "A: こんにちは。\nB: はい、元気です。\n" * 8, "stats": []},
+}, ensure_ascii=False) * 2
+
+SAMPLE_STUDENT = (
+    "Послушай диалог:\n```audio\nA: こんにちは\nB: こんにちは\n```\n\n\n\nA: こんにちは\nBC : はい\n"
+    "Ответь на вопросы.\n\n\n\nАБ: ещё строка"
+)
+
+ALPHABET = (
+    "あいうかきくアイウカキクー漢字日本語々〆ｱｲｳＡＢＣ１２ "
+    "abcXYZабвЖЁё  \t\n:：—-()（）[]{}\"\\,.。、!?"
+)
+
+
+def fuzz_corpus(n: int, seed: int = 42) -> List[str]:
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        k = rnd.randint(0, 80)
+        out.append("".join(rnd.choice(ALPHABET) for _ in range(k)))
+    return out
+
+
+def corpus(fuzz: int) -> List[str]:
+    lines = SAMPLE_SCRIPT.splitlines()
+    return [SAMPLE_SCRIPT, SAMPLE_REPLY, LONG_REPLY, SAMPLE_STUDENT, "", " ", *lines, *fuzz_corpus(fuzz)]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Пары «старое — новое»
+# ─────────────────────────────────────────────────────────────────────────────
+def _new_iter_tts_lines(script: str):
+    return textproc.dialogue_tts_lines(textproc.parse_script(script))
+
+
+def _old_iter_tts_lines(script: str):
+    return legacy_iter_tts_lines(legacy_script_to_dialogue_list(script))
+
+
+PAIRS: Dict[str, Tuple[Callable, Callable]] = {
+    "prepare_tts_text": (legacy_prepare_tts_text, textproc.clean_tts_text),
+    "normalize_speaker_label": (legacy_normalize_speaker_label, textproc.normalize_speaker),
+    "script_to_dialogue_list": (legacy_script_to_dialogue_list, textproc.parse_script),
+    "strip_dialogue_from_student": (legacy_strip_dialogue_from_student, textproc.strip_dialogue),
+    "repair_common_json_glitches": (legacy_repair_common_json_glitches, textproc.repair_json),
+    "extract_json_objects": (legacy_extract_json_objects, textproc.extract_json_objects),
+    "script -> tts lines": (_old_iter_tts_lines, _new_iter_tts_lines),
+}
+
+
+def golden(texts: List[str]) -> int:
+    failures = 0
+    for name, (old, new) in PAIRS.items():
+        checked = 0
+        for text in texts:
+            try:
+                expected = old(text)
+            except Exception:
+                continue  # на таком входе старая функция падала — сверять нечего
+            got = new(text)
+            checked += 1
+            if got != expected:
+                failures += 1
+                if failures <= 20:
+                    print(f"MISMATCH {name}: {text!r}\n  old: {expected!r}\n  new: {got!r}")
+        print(f"golden {name:<30} {checked} inputs")
+    return failures
+
+
+def _per_call_us(fn: Callable, texts: List[str], repeat: int) -> float:
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for text in texts:
+            fn(text)
+        runs.append((time.perf_counter() - t0) / len(texts))
+    return median(runs) * 1e6
+
+
+def bench(repeat: int):
+    inputs = {
+        "prepare_tts_text": SAMPLE_SCRIPT.splitlines(),
+        "normalize_speaker_label": ["A", "В", " c ", "Б"],
+        "script_to_dialogue_list": [SAMPLE_SCRIPT * 4],
+        "strip_dialogue_from_student": [SAMPLE_STUDENT * 4],
+        "repair_common_json_glitches": [SAMPLE_REPLY, LONG_REPLY],
+        "extract_json_objects": [SAMPLE_REPLY, LONG_REPLY],
+        "script -> tts lines": [SAMPLE_SCRIPT * 4],
+    }
+    print(f"\n{'function':<30} {'old_us':>9} {'new_us':>9} {'speedup':>8}")
+    for name, (old, new) in PAIRS.items():
+        texts = inputs[name]
+        t_old = _per_call_us(old, texts, repeat)
+        t_new = _per_call_us(new, texts, repeat)
+        print(f"{name:<30} {t_old:>9.2f} {t_new:>9.2f} {t_old / t_new:>7.1f}x")
+    text = SAMPLE_SCRIPT * 4
+    print(f"{'classify (one pass)':<30} {'':>9} {_per_call_us(textproc.classify, [text], repeat):>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="textproc: сверка со старыми функциями и бенчмарк")
+    parser.add_argument("--fuzz", type=int, default=2000, help="сколько случайных строк в корпусе")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    failures = golden(corpus(args.fuzz))
+    bench(args.repeat)
+    if failures:
+        print(f"\n{failures} mismatches")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,90 @@ TELEGRAM_BOT_TOKEN = _cfg.get("TELEGRAM_BOT_TOKEN", "")
 OPENAI_TEXT_MODEL = _cfg.get("OPENAI_TEXT_MODEL", "gpt-4.1-mini")
 OPENAI_TTS_MODEL = str(_cfg.get("OPENAI_TTS_MODEL", "gpt-4o-mini-tts"))
 OPENAI_TTS_VOICE = str(_cfg.get("OPENAI_TTS_VOICE", "alloy"))
+# формат аудирования: "mp3" (audio-файл) или "opus"/"pcm" (OGG/Opus голосовое сообщение)
+TTS_OUTPUT_FORMAT = str(_cfg.get("TTS_OUTPUT_FORMAT", "mp3")).strip().lower()
+# порядок сообщений: "text_first" — тексты сразу, аудио по готовности; "strict" — аудио перед своим текстом
+AUDIO_ORDER = str(_cfg.get("AUDIO_ORDER", "text_first")).strip().lower()
 
 PROMPT_PATH = BASE_DIR / "prompts" / "system_prompt.txt"
 PDF_DIR = BASE_DIR / "data" / "pdfs"
 CACHE_PATH = BASE_DIR / "data" / "kb_cache.json"
 OUT_AUDIO_DIR = BASE_DIR / "data" / "out_audio"
+DOCS_DIR = BASE_DIR / "docs"
+# пак предсинтезированной озвучки словаря (audio_pack.py); реплики длиннее — всегда живой TTS
+AUDIO_PACK_DIR = BASE_DIR / "data" / "audio_pack"
+AUDIO_PACK_MAX_CHARS = int(_cfg.get("AUDIO_PACK_MAX_CHARS", "24"))
+
+# режим получения апдейтов: "polling" (по умолчанию) или "webhook"
+BOT_MODE = str(_cfg.get("BOT_MODE", "polling")).strip().lower()
+WEBHOOK_LISTEN = str(_cfg.get("WEBHOOK_LISTEN", "0.0.0.0"))
+WEBHOOK_PORT = int(_cfg.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = str(_cfg.get("WEBHOOK_PATH", "/telegram"))
+# публичный URL (https://host/telegram); пустой — setWebhook не вызываем (локальный режим)
+WEBHOOK_URL = str(_cfg.get("WEBHOOK_URL", ""))
+# обязателен при непустом WEBHOOK_URL (заголовок X-Telegram-Bot-Api-Secret-Token)
+WEBHOOK_SECRET_TOKEN = str(_cfg.get("WEBHOOK_SECRET_TOKEN", ""))
+# при такой глубине очереди /ready отвечает 503, чтобы балансировщик снял нагрузку
+WEBHOOK_MAX_QUEUE = int(_cfg.get("WEBHOOK_MAX_QUEUE", "500"))
+
+# исходящие лимиты Telegram: ~30 сообщений/с на бота, ~1/с в один чат
+TG_GLOBAL_RATE = float(_cfg.get("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE = float(_cfg.get("TG_CHAT_RATE", "1"))
+TG_SEND_RETRIES = int(_cfg.get("TG_SEND_RETRIES", "3"))
+
+# фоновая очередь побочных эффектов (jobs.py)
+JOBS_JOURNAL_PATH = BASE_DIR / "data" / "jobs_journal.jsonl"
+JOBS_WORKERS = int(_cfg.get("JOBS_WORKERS", "4"))
+JOBS_MAX_RETRIES = int(_cfg.get("JOBS_MAX_RETRIES", "5"))
+# после стольких завершённых записей журнал переписывается с одними незавершёнными задачами
+JOBS_COMPACT_AFTER = int(_cfg.get("JOBS_COMPACT_AFTER", "1000"))
+
+# пул готовых уроков (lesson_pool.py)
+LESSON_POOL_DIR = BASE_DIR / "data" / "lesson_pool"
+LESSON_POOL_SIZE = int(_cfg.get("LESSON_POOL_SIZE", "5"))  # 0 — пул выключен
+LESSON_POOL_KEYS = str(_cfg.get("LESSON_POOL_KEYS", "N5:аудирование,N5:грамматика,N4:аудирование,N4:грамматика"))
+LESSON_POOL_TTL_HOURS = float(_cfg.get("LESSON_POOL_TTL_HOURS", "168"))
+LESSON_POOL_MAX_SERVES = int(_cfg.get("LESSON_POOL_MAX_SERVES", "50"))
+LESSON_POOL_OFFPEAK_UTC = str(_cfg.get("LESSON_POOL_OFFPEAK_UTC", "1-6"))  # часы UTC, "" — круглосуточно
+LESSON_POOL_CHECK_SEC = float(_cfg.get("LESSON_POOL_CHECK_SEC", "600"))
+
+# бюджет времени на ход и деградация (deadline.py)
+TURN_BUDGET_S = float(_cfg.get("TURN_BUDGET_S", "90"))
+FILE_SEARCH_MIN_BUDGET_S = float(_cfg.get("FILE_SEARCH_MIN_BUDGET_S", "30"))  # меньше — идём без file_search
+AUDIO_MIN_BUDGET_S = float(_cfg.get("AUDIO_MIN_BUDGET_S", "15"))  # меньше — аудио не делаем, шлём уведомление
+BREAKER_FAILURES = int(_cfg.get("BREAKER_FAILURES", "3"))
+BREAKER_RESET_S = float(_cfg.get("BREAKER_RESET_S", "60"))
+
+# сжатая история чатов (history_store.py)
+HISTORY_COMPRESSION = str(_cfg.get("HISTORY_COMPRESSION", "0")).strip().lower() in ("1", "true", "yes", "on")
+HISTORY_DICT_DIR = BASE_DIR / "data" / "history_dicts"
+HISTORY_WINDOW = int(_cfg.get("HISTORY_WINDOW", "0"))  # сколько последних сообщений истории слать в модель; 0 — все
+
+# запись трафика для replay.py (traffic_trace.py): путь к .jsonl.gz, пусто — выключено
+TRACE_CAPTURE_PATH = str(_cfg.get("TRACE_CAPTURE_PATH", ""))
+# секрет для хеша id пользователя в трейсе; пусто — случайный на каждый запуск записи (нигде не хранится).
+# Telegram id — небольшие числа: с известной солью хеш перебирается за минуты
+TRACE_SALT = str(_cfg.get("TRACE_SALT", ""))
+
+# несколько ботов в одном процессе (tenants.py): путь к JSON со списком тенантов, пусто — один бот
+TENANTS_PATH = str(_cfg.get("TENANTS_PATH", ""))
+TENANT_MAX_CONCURRENCY = int(_cfg.get("TENANT_MAX_CONCURRENCY", "4"))  # одновременных ходов на тенанта
+
+# администраторы (через запятую): им доступны скрытые команды, например /prof (profiler.py)
+ADMIN_USER_IDS = {int(x) for x in str(_cfg.get("ADMIN_USER_IDS", "")).split(",") if x.strip()}
+PROFILE_DIR = BASE_DIR / "data" / "profiles"
+PROFILE_SAMPLE_HZ = float(_cfg.get("PROFILE_SAMPLE_HZ", "100"))
+# жёсткий предел сессии /prof (и для «N сообщений»): забытая сессия не висит в проде
+PROFILE_MAX_SEC = float(_cfg.get("PROFILE_MAX_SEC", "600"))
+
+# ночная пакетная подготовка повторения (nightly_review.py)
+REVIEW_ENABLED = str(_cfg.get("REVIEW_ENABLED", "0")).strip().lower() in ("1", "true", "yes", "on")
+REVIEW_BATCH_BACKEND = str(_cfg.get("REVIEW_BATCH_BACKEND", "openai")).strip().lower()  # "openai" | "local"
+REVIEW_HOURS_UTC = str(_cfg.get("REVIEW_HOURS_UTC", "0-4"))  # окно запуска, часы UTC
+REVIEW_ACTIVE_DAYS = float(_cfg.get("REVIEW_ACTIVE_DAYS", "14"))  # готовим только тем, кто был активен
+REVIEW_STATS_LINES = int(_cfg.get("REVIEW_STATS_LINES", "50"))  # последних строк stats.json в запрос
+REVIEW_POLL_SEC = float(_cfg.get("REVIEW_POLL_SEC", "60"))
+REVIEW_CHECK_SEC = float(_cfg.get("REVIEW_CHECK_SEC", "900"))
 
 OUT_AUDIO_DIR.mkdir(parents=True, exist_ok=True)
 PDF_DIR.mkdir(parents=True, exist_ok=True)
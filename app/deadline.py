@@ -0,0 +1,108 @@
+"""
+Бюджет времени на один ход и предохранители (circuit breakers) для внешних зависимостей.
+
+Deadline создаётся в on_message и передаётся вниз: в ChatGPTAgent.send_message
+(таймаут запроса к модели, отказ от file_search) и в tts.synth_dialogue (таймаут на реплику).
+Запросы под бюджетом идут с max_retries=0: ретраи SDK вышли бы за остаток бюджета.
+Каждая деградация считается в metrics как fallback.<имя>.
+
+Предохранитель на зависимость: после BREAKER_FAILURES ошибок подряд она считается
+недоступной BREAKER_RESET_S секунд, затем пропускается одна пробная попытка.
+"""
+import threading
+import time
+from typing import Dict, Optional
+
+from config import BREAKER_FAILURES, BREAKER_RESET_S
+import metrics
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """Таймаут для очередного запроса: остаток бюджета, не больше cap."""
+        rem = self.remaining()
+        return min(rem, cap) if cap is not None else rem
+
+    def check(self, what: str = ""):
+        if self.expired:
+            raise DeadlineExceeded(f"turn budget exhausted{': ' + what if what else ''}")
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_after: float = BREAKER_RESET_S):
+        self.name = name
+        self.failures = failures
+        self.reset_after = reset_after
+        self._count = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_after:
+                # полуоткрытое состояние: одна пробная попытка
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._count = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._count += 1
+            if self._count >= self.failures:
+                if self._opened_at is None:
+                    print(f"[breaker] {self.name} opened after {self._count} failures")
+                    metrics.incr(f"breaker.{self.name}.opened")
+                self._opened_at = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "open" if time.monotonic() - self._opened_at < self.reset_after else "half-open"
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        b = _breakers.get(name)
+        if b is None:
+            b = _breakers[name] = CircuitBreaker(name)
+        return b
+
+
+def breaker_states() -> Dict[str, str]:
+    with _breakers_lock:
+        items = list(_breakers.items())
+    return {name: b.state for name, b in items}
+
+
+def fallback(name: str, detail: str = ""):
+    """Фиксирует срабатывание деградации."""
+    metrics.incr(f"fallback.{name}")
+    print(f"[degrade] {name}{': ' + detail if detail else ''}")
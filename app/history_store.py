@@ -0,0 +1,259 @@
+# app/history_store.py
+"""
+Сжатое хранение истории чатов (ChatGPTAgent.chats[*]["history"]).
+
+Ход истории хранится как {"role": ..., "z": <bytes>, "d": <id словаря>} вместо
+{"role": ..., "content": ...}. Сжатие — zstd со словарём, обученным на наших же уроках
+(одни и те же ключи схемы, таблицы, инструкции); без пакета zstandard — zlib с preset-словарём.
+На диске bytes лежат в base64, в памяти — как bytes. Расжимается только то окно истории,
+которое уходит в модель (HISTORY_WINDOW), с небольшим LRU-кэшем.
+
+Несжатые ходы ({"content": ...}) остаются валидными — формат смешанный, миграция не обязательна.
+
+CLI (из app/):
+  python history_store.py train  --chats ../chats.json   # обучить словарь на текущей истории
+  python history_store.py report --chats ../chats.json   # экономия диска и памяти
+"""
+import argparse
+import base64
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from config import HISTORY_DICT_DIR
+
+try:
+    import zstandard
+except ImportError:  # необязательная зависимость
+    zstandard = None
+
+
+BACKEND = "zstd" if zstandard is not None else "zlib"
+ZSTD_DICT_SIZE = 112 * 1024
+ZLIB_DICT_SIZE = 32 * 1024  # больше zlib всё равно не использует
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 9
+CURRENT_RECHECK_S = 60.0  # как часто перечитывать CURRENT (словарь обучают отдельным процессом)
+RE_FRAGMENT = re.compile(r"(?<=[\n,{}\[\]])")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Словари
+# ─────────────────────────────────────────────────────────────────────────────
+NO_DICT = f"{BACKEND}-none"  # id «без словаря»: бэкенд всё равно зашит в id
+
+
+def _dict_id(data: bytes) -> str:
+    return f"{BACKEND}-{hashlib.sha1(data).hexdigest()[:12]}"
+
+
+def train_dictionary(samples: List[str]) -> bytes:
+    raw = [s.encode("utf-8") for s in samples if s]
+    if zstandard is not None:
+        return zstandard.train_dictionary(ZSTD_DICT_SIZE, raw).as_bytes()
+    # zlib: самые частые фрагменты (строки и куски JSON между , { } [ ]),
+    # самые частые — в конце словаря (они ближе всего к сжимаемым данным)
+    counts = Counter(
+        frag for s in samples for frag in RE_FRAGMENT.split(s) if len(frag.strip()) > 3
+    )
+    picked: List[bytes] = []
+    size = 0
+    for frag, n in counts.most_common():
+        if n < 2:
+            break
+        b = frag.encode("utf-8")
+        if size + len(b) > ZLIB_DICT_SIZE:
+            continue
+        picked.append(b)
+        size += len(b)
+    return b"".join(reversed(picked))
+
+
+def save_dictionary(data: bytes, base: Path = HISTORY_DICT_DIR) -> str:
+    base.mkdir(parents=True, exist_ok=True)
+    did = _dict_id(data)
+    (base / f"{did}.dict").write_bytes(data)
+    (base / "CURRENT").write_text(did, encoding="utf-8")
+    _current_cache.clear()
+    return did
+
+
+@lru_cache(maxsize=8)
+def _load_dictionary(did: str, base: Path = HISTORY_DICT_DIR) -> bytes:
+    if not did or did.endswith("-none"):
+        return b""
+    return (base / f"{did}.dict").read_bytes()
+
+
+_current_cache: Dict[Path, tuple] = {}  # base → (id, когда прочитан)
+
+
+def current_dictionary_id(base: Path = HISTORY_DICT_DIR) -> str:
+    """Id словаря для новых ходов; CURRENT читается с диска не чаще раза в CURRENT_RECHECK_S."""
+    cached = _current_cache.get(base)
+    now = time.monotonic()
+    if cached is not None and now - cached[1] < CURRENT_RECHECK_S:
+        return cached[0]
+    p = base / "CURRENT"
+    did = p.read_text(encoding="utf-8").strip() if p.exists() else ""
+    # словарь, обученный другим бэкендом, для новых ходов не годится
+    did = did if did and _backend_of(did) == BACKEND else NO_DICT
+    _current_cache[base] = (did, now)
+    return did
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Кодек ходов
+# ─────────────────────────────────────────────────────────────────────────────
+def _backend_of(did: str) -> str:
+    return did.split("-", 1)[0] if did else BACKEND
+
+
+# Кодеки строятся один раз на словарь: zstd-(де)компрессоры не потокобезопасны — свои в каждом
+# потоке; у zlib объекты одноразовые — держим заготовку со словарём и копируем её (copy()).
+_codecs = threading.local()
+
+
+@lru_cache(maxsize=8)
+def _zstd_dict(did: str):
+    zdict = _load_dictionary(did)
+    return zstandard.ZstdCompressionDict(zdict) if zdict else None
+
+
+def _thread_codec(kind: str, did: str, make):
+    cache = getattr(_codecs, kind, None)
+    if cache is None:
+        cache = {}
+        setattr(_codecs, kind, cache)
+    codec = cache.get(did)
+    if codec is None:
+        codec = cache[did] = make()
+    return codec
+
+
+@lru_cache(maxsize=8)
+def _zlib_compressor(did: str):
+    zdict = _load_dictionary(did)
+    return zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -15, zdict=zdict) if zdict else zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -15)
+
+
+@lru_cache(maxsize=8)
+def _zlib_decompressor(did: str):
+    zdict = _load_dictionary(did)
+    return zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+
+
+def compress_text(text: str, did: str) -> bytes:
+    data = text.encode("utf-8")
+    if _backend_of(did) == "zstd":
+        cctx = _thread_codec("zstd_c", did, lambda: zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_zstd_dict(did)))
+        return cctx.compress(data)
+    c = _zlib_compressor(did).copy()
+    return c.compress(data) + c.flush()
+
+
+@lru_cache(maxsize=512)
+def decompress_text(blob: bytes, did: str) -> str:
+    if _backend_of(did) == "zstd":
+        if zstandard is None:
+            raise RuntimeError("история сжата zstd, а пакет zstandard не установлен")
+        dctx = _thread_codec("zstd_d", did, lambda: zstandard.ZstdDecompressor(dict_data=_zstd_dict(did)))
+        return dctx.decompress(blob).decode("utf-8")
+    dobj = _zlib_decompressor(did).copy()
+    return (dobj.decompress(blob) + dobj.flush()).decode("utf-8")
+
+
+def encode_turn(role: str, content: str, did: Optional[str] = None) -> Dict:
+    did = current_dictionary_id() if did is None else did
+    return {"role": role, "z": compress_text(content, did), "d": did}
+
+
+def decode_turn(turn: Dict) -> Dict[str, str]:
+    """Ход в обычном виде {"role", "content"} (несжатые возвращаются как есть)."""
+    if "z" not in turn:
+        return turn
+    return {"role": turn["role"], "content": decompress_text(turn["z"], turn.get("d", NO_DICT))}
+
+
+def hydrate_history(history: List[Dict]):
+    """После json.load: base64-строки "z" → bytes (in-place)."""
+    for turn in history:
+        if isinstance(turn.get("z"), str):
+            turn["z"] = base64.b64decode(turn["z"])
+
+
+def json_default(obj):
+    """Для json.dump: bytes сжатых ходов → base64."""
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode("ascii")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# CLI
+# ─────────────────────────────────────────────────────────────────────────────
+def _plain_turns(chats: Dict) -> List[Dict[str, str]]:
+    turns = []
+    for cid, chat in chats.items():
+        if cid == "__users__" or not isinstance(chat, dict):
+            continue
+        for t in chat.get("history", []):
+            hydrate_history([t])
+            turns.append(decode_turn(t))
+    return turns
+
+
+def _report(chats_path: Path):
+    chats = json.loads(chats_path.read_text(encoding="utf-8"))
+    turns = _plain_turns(chats)
+    did = current_dictionary_id()
+    if did == NO_DICT:
+        print("Словарь не обучен: сначала `python history_store.py train`")
+        return
+
+    raw_mem = sum(sys.getsizeof(t["content"]) for t in turns)
+    enc = [compress_text(t["content"], did) for t in turns]
+    z_mem = sum(sys.getsizeof(b) for b in enc)
+    no_dict = sum(len(compress_text(t["content"], NO_DICT)) for t in turns)
+    raw_disk = chats_path.stat().st_size
+    plain_disk = sum(len(json.dumps(t["content"], ensure_ascii=False).encode("utf-8")) for t in turns)
+    z_disk = sum(len(base64.b64encode(b)) + len(did) + 12 for b in enc)
+    dict_size = len(_load_dictionary(did))
+
+    print(f"backend: {_backend_of(did)}, dictionary {did} ({dict_size / 1024:.1f} KiB)")
+    print(f"turns: {len(turns)}")
+    print(f"history on disk: {plain_disk / 1024:.1f} KiB -> {z_disk / 1024:.1f} KiB "
+          f"(chats.json total {raw_disk / 1024:.1f} KiB, saving {(plain_disk - z_disk) / 1024:.1f} KiB)")
+    print(f"history in memory: {raw_mem / 1024:.1f} KiB -> {z_mem / 1024:.1f} KiB")
+    print(f"compressed bytes with dictionary: {sum(len(b) for b in enc) / 1024:.1f} KiB, "
+          f"without: {no_dict / 1024:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сжатая история чатов")
+    parser.add_argument("cmd", choices=["train", "report"])
+    parser.add_argument("--chats", type=Path, default=Path("./chats.json"))
+    args = parser.parse_args()
+
+    if args.cmd == "train":
+        chats = json.loads(args.chats.read_text(encoding="utf-8"))
+        samples = [t["content"] for t in _plain_turns(chats)]
+        if not samples:
+            print("История пуста — обучать не на чем")
+            return
+        did = save_dictionary(train_dictionary(samples))
+        print(f"trained {did} on {len(samples)} turns")
+    else:
+        _report(args.chats)
+
+
+if __name__ == "__main__":
+    main()
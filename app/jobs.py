@@ -0,0 +1,208 @@
+"""
+Фоновая очередь побочных эффектов после ответа ученику
+(save_score / append_tech_stats / append_stats / sync_user_stats_to_vs).
+
+- у каждого пользователя своя «полоса»: его задачи выполняются строго по порядку,
+  разные пользователи — параллельно, не больше `workers` одновременно; при нескольких
+  тенантах полоса — (тенант, пользователь): один Telegram-id у разных ботов — разные ученики;
+- coalesce=True: новая задача того же вида вытесняет ещё не начатую старую
+  (синхронизация VS читает файл в момент запуска, поэтому достаточно последней);
+- ретраи с экспоненциальной паузой;
+- журнал на диске (JSONL): задача пишется при постановке и помечается done по завершении,
+  после рестарта незавершённые задачи поднимаются из журнала; на ходу журнал
+  компактируется, как только завершённых записей набирается compact_after.
+"""
+import asyncio
+import json
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from config import JOBS_JOURNAL_PATH, JOBS_WORKERS, JOBS_MAX_RETRIES, JOBS_COMPACT_AFTER
+
+
+@dataclass
+class Job:
+    kind: str
+    user: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    coalesce: bool = False
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    attempts: int = 0
+
+    @property
+    def lane(self) -> str:
+        tenant = self.payload.get("tenant")
+        return f"{tenant}:{self.user}" if tenant else self.user
+
+
+class BackgroundJobs:
+    def __init__(
+        self,
+        journal_path: Path = JOBS_JOURNAL_PATH,
+        workers: int = JOBS_WORKERS,
+        max_retries: int = JOBS_MAX_RETRIES,
+        compact_after: int = JOBS_COMPACT_AFTER,
+    ):
+        self.journal_path = Path(journal_path)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.compact_after = compact_after
+        self._closed_records = 0  # done / dead / coalesced с последней компактации
+        self._handlers: Dict[str, Callable[..., Any]] = {}
+        self._lanes: Dict[str, Deque[Job]] = {}
+        self._scheduled: Set[str] = set()
+        self._running: Set[str] = set()
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._journal = None
+
+    def register(self, kind: str, fn: Callable[..., Any]):
+        """fn(user_id, **payload) — синхронная функция, выполняется в отдельном потоке."""
+        self._handlers[kind] = fn
+
+    # ----- журнал -----
+
+    def _write(self, record: dict):
+        if self._journal is None:
+            return
+        self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        if record.get("op") != "add":
+            self._closed_records += 1
+
+    def _rewrite(self, jobs: List[Job]):
+        """Журнал заново: только add-записи переданных задач (tmp + replace — без полу-записанного файла)."""
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.journal_path.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            for job in jobs:
+                f.write(json.dumps(self._add_record(job), ensure_ascii=False) + "\n")
+        tmp.replace(self.journal_path)
+        self._closed_records = 0
+
+    def _maybe_compact(self):
+        """Вызывается между задачами: всё, что лежит в полосах, ещё не завершено."""
+        if self._journal is None or self._closed_records < self.compact_after:
+            return
+        self._journal.close()
+        self._rewrite([job for lane in self._lanes.values() for job in lane])
+        self._journal = self.journal_path.open("a", encoding="utf-8")
+
+    def _recover(self) -> List[Job]:
+        """Незавершённые задачи из журнала + компактирование журнала до них."""
+        pending: Dict[str, Job] = {}
+        if self.journal_path.exists():
+            with self.journal_path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # недописанная строка при падении
+                    if rec.get("op") == "add":
+                        pending[rec["id"]] = Job(
+                            kind=rec["kind"], user=rec["user"], payload=rec.get("payload") or {},
+                            coalesce=bool(rec.get("coalesce")), id=rec["id"],
+                        )
+                    else:
+                        pending.pop(rec.get("id"), None)
+
+        self._rewrite(list(pending.values()))
+        return list(pending.values())
+
+    @staticmethod
+    def _add_record(job: Job) -> dict:
+        return {"op": "add", "id": job.id, "kind": job.kind, "user": job.user,
+                "payload": job.payload, "coalesce": job.coalesce}
+
+    # ----- постановка -----
+
+    def enqueue(self, kind: str, user_id, payload: Optional[Dict[str, Any]] = None, coalesce: bool = False) -> str:
+        job = Job(kind=kind, user=str(user_id), payload=payload or {}, coalesce=coalesce)
+        self._write(self._add_record(job))
+        self._push(job)
+        return job.id
+
+    def _push(self, job: Job):
+        lane = self._lanes.setdefault(job.lane, deque())
+        if job.coalesce:
+            for old in [j for j in lane if j.kind == job.kind and j.id not in self._running]:
+                lane.remove(old)
+                self._write({"op": "coalesced", "id": old.id, "into": job.id})
+        lane.append(job)
+        if job.lane not in self._scheduled and self._ready is not None:
+            self._scheduled.add(job.lane)
+            self._ready.put_nowait(job.lane)
+
+    def depth(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    # ----- выполнение -----
+
+    async def start(self):
+        self._ready = asyncio.Queue()
+        self._journal = None
+        recovered = self._recover()
+        self._journal = self.journal_path.open("a", encoding="utf-8")
+        for job in recovered:
+            self._push(job)
+        # полосы, в которых задачи уже лежали до start()
+        for key, lane in self._lanes.items():
+            if lane and key not in self._scheduled:
+                self._scheduled.add(key)
+                self._ready.put_nowait(key)
+        if recovered:
+            print(f"[jobs] recovered {len(recovered)} pending jobs from journal")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            lane = self._lanes.get(key)
+            try:
+                while lane:
+                    job = lane[0]
+                    self._running.add(job.id)
+                    try:
+                        await self._run(job)
+                    finally:
+                        self._running.discard(job.id)
+                    lane.popleft()
+                    self._maybe_compact()
+            finally:
+                # при отмене (stop) недоделанное остаётся в журнале и поднимется после рестарта
+                self._scheduled.discard(key)
+                if not lane:
+                    self._lanes.pop(key, None)
+
+    async def _run(self, job: Job):
+        fn = self._handlers.get(job.kind)
+        if fn is None:
+            print(f"[jobs] no handler for {job.kind}, dropping {job.id}")
+            self._write({"op": "dead", "id": job.id})
+            return
+        while True:
+            try:
+                await asyncio.to_thread(fn, job.user, **job.payload)
+                self._write({"op": "done", "id": job.id})
+                return
+            except Exception as e:
+                job.attempts += 1
+                if job.attempts > self.max_retries:
+                    print(f"[jobs] {job.kind} for user {job.user} failed permanently: {e}")
+                    self._write({"op": "dead", "id": job.id, "error": str(e)})
+                    return
+                delay = min(2 ** job.attempts, 60)
+                print(f"[jobs] {job.kind} for user {job.user} failed ({e}), retry in {delay}s")
+                await asyncio.sleep(delay)
@@ -0,0 +1,274 @@
+"""
+Пул заранее сгенерированных уроков по (уровень JLPT, тип упражнения).
+
+Типовые запросы («дай аудирование N5», «new N4 grammar test») обслуживаются из пула
+без похода в модель: payload уже проверен по JSON-схеме ответа, аудио уже озвучено.
+
+  data/lesson_pool/<level>_<type>/<id>.json   — {"id", "created_at", "serves", "payload", "audio"}
+  data/lesson_pool/<level>_<type>/<id>.<ext>  — готовое аудио (если есть audio_script)
+  data/lesson_pool/_seen/<user_id>.txt        — id выданных ученику элементов (дедупликация)
+
+Пул пополняется фоновым воркером только в «тихие» часы (LESSON_POOL_OFFPEAK_UTC).
+Элемент удаляется по истечении TTL или после LESSON_POOL_MAX_SERVES выдач.
+"""
+import asyncio
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Callable, List, Optional, Set, Tuple
+
+from config import (
+    LESSON_POOL_DIR, LESSON_POOL_SIZE, LESSON_POOL_KEYS, LESSON_POOL_TTL_HOURS,
+    LESSON_POOL_MAX_SERVES, LESSON_POOL_OFFPEAK_UTC, LESSON_POOL_CHECK_SEC,
+)
+import metrics
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Распознавание типового запроса
+# ─────────────────────────────────────────────────────────────────────────────
+MAX_GENERIC_LEN = 80  # длинные сообщения — уже не «типовой» запрос, а разговор
+
+RE_LEVEL = re.compile(r"\b[NnНн]\s?([1-5])\b")
+TYPE_PATTERNS: List[Tuple[str, re.Pattern]] = [
+    ("аудирование", re.compile(r"аудир|listening|послуша", re.IGNORECASE)),
+    ("грамматика", re.compile(r"граммат|grammar", re.IGNORECASE)),
+    ("кандзи", re.compile(r"кандзи|kanji|иероглиф", re.IGNORECASE)),
+    ("лексика", re.compile(r"лексик|vocab|словар|слова", re.IGNORECASE)),
+    ("чтение", re.compile(r"чтени|reading|прочита", re.IGNORECASE)),
+]
+RE_CONTEXTUAL = re.compile(r"ответ|answer|ошиб|mistake|почему|why|\?|？", re.IGNORECASE)
+
+
+def match_generic_request(text: str) -> Optional[Tuple[str, str]]:
+    """
+    («N5», «аудирование») для сообщений вида «дай новое аудирование N5»; иначе None.
+    Ответы на задания и вопросы в пул не идут — им нужен контекст диалога.
+    """
+    t = (text or "").strip()
+    if not t or len(t) > MAX_GENERIC_LEN or RE_CONTEXTUAL.search(t):
+        return None
+    m = RE_LEVEL.search(t)
+    if not m:
+        return None
+    for ex_type, pat in TYPE_PATTERNS:
+        if pat.search(t):
+            return f"N{m.group(1)}", ex_type
+    return None
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Проверка payload по JSON-схеме ответа (подмножество, которое использует RESPONSE_FORMAT)
+# ─────────────────────────────────────────────────────────────────────────────
+def validate_schema(value, schema: dict) -> bool:
+    if "enum" in schema and value not in schema["enum"]:
+        return False
+    t = schema.get("type")
+    if t == "object":
+        if not isinstance(value, dict):
+            return False
+        props = schema.get("properties", {})
+        if any(k not in value for k in schema.get("required", [])):
+            return False
+        if schema.get("additionalProperties") is False and any(k not in props for k in value):
+            return False
+        return all(validate_schema(v, props[k]) for k, v in value.items() if k in props)
+    if t == "array":
+        return isinstance(value, list) and all(validate_schema(v, schema.get("items", {})) for v in value)
+    if t == "string":
+        return isinstance(value, str)
+    if t == "integer":
+        if not isinstance(value, int) or isinstance(value, bool):
+            return False
+        if "minimum" in schema and value < schema["minimum"]:
+            return False
+        if "maximum" in schema and value > schema["maximum"]:
+            return False
+    return True
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Пул
+# ─────────────────────────────────────────────────────────────────────────────
+@dataclass
+class PoolItem:
+    id: str
+    level: str
+    ex_type: str
+    payload: str
+    audio: Optional[Path]  # временная копия, вызывающий удаляет её после отправки
+
+
+def parse_pool_keys(spec: str) -> List[Tuple[str, str]]:
+    """"N5:аудирование,N4:грамматика" -> [("N5", "аудирование"), ("N4", "грамматика")]"""
+    keys = []
+    for part in spec.split(","):
+        level, _, ex_type = part.strip().partition(":")
+        if level and ex_type:
+            keys.append((level.strip().upper(), ex_type.strip()))
+    return keys
+
+
+def _in_hours(spec: str, hour: int) -> bool:
+    """"1-6" / "22-5" (через полночь) / "" (всегда)."""
+    if not spec.strip():
+        return True
+    start, _, end = spec.partition("-")
+    start, end = int(start), int(end or start)
+    if start <= end:
+        return start <= hour <= end
+    return hour >= start or hour <= end
+
+
+class LessonPool:
+    def __init__(
+        self,
+        base_dir: Path = LESSON_POOL_DIR,
+        size: int = LESSON_POOL_SIZE,
+        ttl: timedelta = timedelta(hours=LESSON_POOL_TTL_HOURS),
+        max_serves: int = LESSON_POOL_MAX_SERVES,
+    ):
+        self.base_dir = Path(base_dir)
+        self.size = size
+        self.ttl = ttl
+        self.max_serves = max_serves
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _key_dir(self, level: str, ex_type: str) -> Path:
+        p = self.base_dir / f"{level}_{ex_type}"
+        p.mkdir(parents=True, exist_ok=True)
+        return p
+
+    def _seen_path(self, user_id) -> Path:
+        p = self.base_dir / "_seen"
+        p.mkdir(parents=True, exist_ok=True)
+        return p / f"{user_id}.txt"
+
+    def _seen(self, user_id) -> Set[str]:
+        p = self._seen_path(user_id)
+        return set(p.read_text(encoding="utf-8").split()) if p.exists() else set()
+
+    def _expired(self, meta: dict) -> bool:
+        created = datetime.fromisoformat(meta["created_at"])
+        return (datetime.now(timezone.utc) - created > self.ttl) or meta.get("serves", 0) >= self.max_serves
+
+    def _remove(self, meta_path: Path, meta: dict):
+        meta_path.unlink(missing_ok=True)
+        if meta.get("audio"):
+            (meta_path.parent / meta["audio"]).unlink(missing_ok=True)
+
+    def _live_items(self, level: str, ex_type: str) -> List[Tuple[Path, dict]]:
+        """Неистёкшие элементы, от старых к новым; истёкшие попутно удаляются."""
+        items = []
+        for meta_path in sorted(self._key_dir(level, ex_type).glob("*.json")):
+            try:
+                meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError):
+                meta_path.unlink(missing_ok=True)
+                continue
+            if self._expired(meta):
+                self._remove(meta_path, meta)
+                continue
+            items.append((meta_path, meta))
+        items.sort(key=lambda it: it[1]["created_at"])
+        return items
+
+    def count(self, level: str, ex_type: str) -> int:
+        with self._lock:
+            return len(self._live_items(level, ex_type))
+
+    def take(self, level: str, ex_type: str, user_id) -> Optional[PoolItem]:
+        """Самый старый элемент, который этот ученик ещё не видел; None — промах."""
+        with self._lock:
+            seen = self._seen(user_id)
+            for meta_path, meta in self._live_items(level, ex_type):
+                if meta["id"] in seen:
+                    continue
+                meta["serves"] = meta.get("serves", 0) + 1
+                meta_path.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+                with self._seen_path(user_id).open("a", encoding="utf-8") as f:
+                    f.write(meta["id"] + "\n")
+                audio = None
+                if meta.get("audio"):
+                    # отдаём копию: оригинал может истечь и удалиться, пока копия отправляется
+                    fd, tmp = tempfile.mkstemp(suffix=Path(meta["audio"]).suffix)
+                    os.close(fd)
+                    shutil.copyfile(meta_path.parent / meta["audio"], tmp)
+                    audio = Path(tmp)
+                return PoolItem(meta["id"], level, ex_type, meta["payload"], audio)
+        return None
+
+    def add(self, level: str, ex_type: str, payload: str, audio_path: Optional[Path] = None) -> str:
+        item_id = f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        key_dir = self._key_dir(level, ex_type)
+        audio_name = None
+        if audio_path is not None:
+            audio_name = f"{item_id}{Path(audio_path).suffix}"
+            shutil.move(str(audio_path), key_dir / audio_name)
+        meta = {
+            "id": item_id,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "serves": 0,
+            "payload": payload,
+            "audio": audio_name,
+        }
+        with self._lock:
+            (key_dir / f"{item_id}.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        return item_id
+
+    # ----- пополнение -----
+
+    def refill_once(self, keys: List[Tuple[str, str]], produce: Callable[[str, str], Optional[Tuple[str, Optional[Path]]]]) -> int:
+        """
+        Доводит каждый ключ до self.size. produce(level, type) -> (payload, audio_path) или None,
+        если модель вернула невалидный ответ. Возвращает число добавленных элементов.
+        """
+        added = 0
+        for level, ex_type in keys:
+            missing = self.size - self.count(level, ex_type)
+            for _ in range(max(0, missing)):
+                try:
+                    produced = produce(level, ex_type)
+                except Exception as e:
+                    print(f"[pool] generation failed for {level}/{ex_type}: {e}")
+                    metrics.incr("pool.generate_error")
+                    break
+                if produced is None:
+                    metrics.incr("pool.generate_invalid")
+                    continue
+                self.add(level, ex_type, *produced)
+                added += 1
+        return added
+
+    async def _refill_loop(self, keys, produce, offpeak: str, interval: float):
+        while True:
+            if _in_hours(offpeak, datetime.now(timezone.utc).hour):
+                added = await asyncio.to_thread(self.refill_once, keys, produce)
+                if added:
+                    print(f"[pool] refilled {added} lessons")
+            await asyncio.sleep(interval)
+
+    def start_refill(
+        self,
+        produce: Callable[[str, str], Optional[Tuple[str, Optional[Path]]]],
+        keys: Optional[List[Tuple[str, str]]] = None,
+        offpeak: str = LESSON_POOL_OFFPEAK_UTC,
+        interval: float = LESSON_POOL_CHECK_SEC,
+    ):
+        keys = keys if keys is not None else parse_pool_keys(LESSON_POOL_KEYS)
+        if keys and self.size > 0:
+            self._task = asyncio.create_task(self._refill_loop(keys, produce, offpeak, interval))
+
+    async def stop_refill(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -1,20 +1,35 @@
 import asyncio
 import json
 from pathlib import Path
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
 from datetime import datetime, timezone
-import re
 import os
+import signal
+import time
+from contextlib import asynccontextmanager, suppress
 
 from dotenv import dotenv_values
 from telegram import Update
-from telegram.constants import ChatAction, ParseMode
-from telegram.ext import Application, MessageHandler, ContextTypes, filters
-from telegram.helpers import escape_markdown
-
-from config import TELEGRAM_BOT_TOKEN, PROMPT_PATH
-from tts import synth_dialogue_to_mp3
+from telegram.constants import ChatAction
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+
+from config import (
+    TELEGRAM_BOT_TOKEN, PROMPT_PATH, BOT_MODE, AUDIO_ORDER, TURN_BUDGET_S, AUDIO_MIN_BUDGET_S,
+    TENANTS_PATH, WEBHOOK_PATH, WEBHOOK_URL, ADMIN_USER_IDS, REVIEW_ENABLED,
+)
+from tts import synth_dialogue
 from openai_client import ChatGPTAgent
+from sender import TelegramSender, MAX_TG_TEXT
+from jobs import BackgroundJobs
+from lesson_pool import LessonPool, match_generic_request, validate_schema
+from tenants import Tenant, current_tenant, get_tenant, load_tenants, run_blocking, shutdown_executors
+from nightly_review import NightlyReview, is_opening_message, restore_review, take_review, today_utc
+from deadline import Deadline, DeadlineExceeded, breaker, fallback
+import metrics
+import traffic_trace
+import textproc
+import profiler
+from profiler import profiled
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -98,81 +113,71 @@ except Exception:
 BASE_DIR = Path(__file__).resolve().parent
 # STUDENTS_DIR = BASE_DIR / "data" / "students"
 # STUDENTS_DIR.mkdir(parents=True, exist_ok=True)
-MAX_TG_TEXT = 4000  # чуть меньше реального лимита
-RE_FENCED_AUDIO = re.compile(r"```(?:audio|jp-audio|audio-script)\s*[\s\S]*?```", re.IGNORECASE)
-RE_SPEAKER_LINES = re.compile(r"^(?:[A-ZА-ЯЁ]{1,2}\s*:\s*.+)$", re.MULTILINE)
+sender = TelegramSender()
 
 
+@profiled("extract_json_objects")
 def extract_json_objects(raw: str):
     """
     Возвращает список строк, каждая из которых — один валидный JSON-объект.
     Работает по балансировке фигурных скобок на верхнем уровне.
     Игнорирует текст вне объектов.
     """
-    objs = []
-    depth = 0
-    start = None
-    in_str = False
-    esc = False
-
-    for i, ch in enumerate(raw):
-        if depth == 0:
-            if ch == '{':
-                depth = 1
-                start = i
-        else:
-            if in_str:
-                if esc:
-                    esc = False
-                elif ch == '\\':
-                    esc = True
-                elif ch == '"':
-                    in_str = False
-            else:
-                if ch == '"':
-                    in_str = True
-                elif ch == '{':
-                    depth += 1
-                elif ch == '}':
-                    depth -= 1
-                    if depth == 0 and start is not None:
-                        objs.append(raw[start:i+1])
-                        start = None
-    return objs
+    return textproc.extract_json_objects(raw)
 
 def repair_common_json_glitches(raw: str) -> str:
-    s = raw
-
-    # 1) Лишняя ] сразу после "audio_script":  ..."audio_script": "...."] , "stats"
-    s = re.sub(
-        r'("audio_script"\s*:\s*"(?:[^"\\]|\\.)*")\s*\]\s*,',
-        r'\1,',
-        s,
-        flags=re.DOTALL
-    )
-
-    # 2) Запятая перед закрывающей } (висячая запятая на конце объекта)
-    s = re.sub(r',\s*}', r'}', s)
-
-    # 3) Двойные JSONы подряд без разделителя → попытаемся вытащить по фигурным скобкам
-    # (основную работу у нас уже делает extract_json_objects, оставим как есть)
+    # лишняя ] после "audio_script" и висячая запятая перед } (см. textproc.repair_json)
+    return textproc.repair_json(raw)
 
-    return s
+def parse_assistant_objects(assistant_raw: str) -> List[str]:
+    """Ответ модели → список JSON-объектов (строками); пустой список, если JSON не нашёлся."""
+    # Сначала попробуем прямой парсинг всего ответа (вдруг уже валиден)
+    try:
+        json.loads(assistant_raw)
+        return [assistant_raw]
+    except Exception:
+        pass
+    # Чиним распространённые баги формата
+    fixed = repair_common_json_glitches(assistant_raw)
+    # Пытаемся ещё раз целиком
+    try:
+        json.loads(fixed)
+        return [fixed]
+    except Exception:
+        # Падаем на мульти-объекты: вытаскиваем каждый по балансировке скобок
+        return extract_json_objects(fixed)
 
 async def reply_student_text(update, text: str):
+    """
+    Ставит текст в очередь исходящих (см. sender.py): разбивка по абзацам до экранирования,
+    склейка мелких сообщений, лимиты Telegram. Отправка — в flush_replies().
+    """
     if not text:
-        await update.message.reply_text("Пустое поле Student.")
-        return
-    # безопасно экранируем под MarkdownV2
-    safe = escape_markdown(text, version=2)
-    # режем по блокам, чтобы не превысить лимит
-    for i in range(0, len(safe), MAX_TG_TEXT):
-        chunk = safe[i:i+MAX_TG_TEXT]
-        await update.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN_V2)
+        text = "Пустое поле Student."
+    sender.queue_text(update.get_bot(), update.effective_chat.id, text)
+
+async def flush_replies(update):
+    await sender.flush(update.get_bot(), update.effective_chat.id)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Ресурсы текущего тенанта (tenants.py); в режиме одного бота — глобальные
+# ─────────────────────────────────────────────────────────────────────────────
+def current_agent() -> ChatGPTAgent:
+    tenant = current_tenant.get()
+    return tenant.agent if tenant else agent
+
+def current_prompt() -> str:
+    tenant = current_tenant.get()
+    return tenant.system_prompt if tenant else SYSTEM_PROMPT
+
+def current_pool() -> LessonPool:
+    tenant = current_tenant.get()
+    return tenant.lesson_pool if tenant else lesson_pool
 
 def abs_students_dir() -> Path:
     project_root = Path(__file__).resolve().parents[1]  # подняться из app/ к корню
-    return (project_root / STUDENTS_DIR).resolve()
+    tenant = current_tenant.get()
+    return (project_root / (tenant.students_dir if tenant else STUDENTS_DIR)).resolve()
 
 def student_dir(user_id: int | str) -> Path:
     p = abs_students_dir() / str(user_id)
@@ -182,10 +187,12 @@ def student_dir(user_id: int | str) -> Path:
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
-def save_score(user_id: Union[int, str], score: int):
+def save_score(user_id: Union[int, str], score: int, level: Union[str, None] = None):
     p = student_dir(user_id) / "score.json"
-    payload = {"score": int(score), "updated_at_utc": utc_now_iso()}
+    payload = {"score": int(score), "level": level, "updated_at_utc": utc_now_iso()}
     p.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    fields = {"score": int(score), **({"level": level} if level else {})}
+    current_agent().index.upsert(str(user_id), **fields)
 
 def append_stats(user_id: Union[int, str], stats: list):
     """
@@ -257,30 +264,11 @@ def script_to_dialogue_list(script: str) -> List[Dict[str, str]]:
     в [{"speaker":"A","jp":"こんにちは"}, ...].
     Допускает полноширинный двоеточие и случайные пробелы.
     """
-    dialogue = []
-    for raw in script.splitlines():
-        line = raw.strip()
-        if not line:
-            continue
-        # split по первому ":" или "："
-        parts = re.split(r"\s*[:：]\s*", line, maxsplit=1)
-        if len(parts) == 2 and parts[0]:
-            sp, jp = parts[0].strip(), parts[1].strip()
-        else:
-            sp, jp = "", line
-        dialogue.append({"speaker": sp, "jp": jp})
-    return dialogue
+    return textproc.parse_script(script)
 
 
 def strip_dialogue_from_student(text: str) -> str:
-    if not text:
-        return text
-    t = RE_FENCED_AUDIO.sub("", text)
-    # Если много реплик, часто полезно убрать подряд идущие "A: ..." строки
-    t = RE_SPEAKER_LINES.sub("", t)
-    # подчистка лишних пустых строк
-    t = re.sub(r"\n{3,}", "\n\n", t).strip()
-    return t
+    return textproc.strip_dialogue(text)
 
 def save_last_audio_script(user_id: Union[int, str], script: str):
     student_dir(user_id).joinpath("last_audio_script.txt").write_text(script, encoding="utf-8")
@@ -299,89 +287,260 @@ def clear_awaiting_dialog_dump(user_id: Union[int, str]):
         f.unlink()
 
 # ─────────────────────────────────────────────────────────────────────────────
-# Telegram: единый обработчик текстовых сообщений (бот — прокси к ассистенту)
+# Фоновые побочные эффекты (см. jobs.py): ученик не ждёт записи файлов и синка VS
 # ─────────────────────────────────────────────────────────────────────────────
-async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message or not update.message.text:
-        return
+jobs = BackgroundJobs()
 
-    user_text = update.message.text.strip()
-    tg_user_id: Union[int, str] = update.effective_user.id
+def _in_tenant(fn):
+    """Задача выполняется в потоке воркера: восстанавливаем тенант из payload."""
+    def wrapper(uid, tenant: Union[str, None] = None, **kwargs):
+        current_tenant.set(get_tenant(tenant))
+        return fn(uid, **kwargs)
+    return wrapper
 
-    # гарантируем чат для данного Telegram-пользователя
-    chat_id = agent.ensure_user_chat(
-        telegram_user_id=tg_user_id,
-        system_prompt=SYSTEM_PROMPT,
-        response_format=RESPONSE_FORMAT,
-        title=f"user:{tg_user_id}"
-    )
+jobs.register("save_score", _in_tenant(lambda uid, score, level=None: save_score(uid, score, level)))
+jobs.register("append_tech_stats", _in_tenant(lambda uid, tech_stats: append_tech_stats(uid, tech_stats)))
+jobs.register("append_stats", _in_tenant(lambda uid, stats: append_stats(uid, stats)))
 
-    # раз в день прикладываем tech_stats к запросу в ассистента
-    user_text_for_agent = inject_daily_tech_stats(user_text, tg_user_id)
+def _sync_vs_job(uid: str):
+    vs_breaker = breaker("vector_store")
+    try:
+        current_agent().sync_user_stats_to_vs(uid)
+    except Exception:
+        vs_breaker.record_failure()
+        raise
+    vs_breaker.record_success()
 
-    await update.message.chat.send_action(ChatAction.TYPING)
+jobs.register("sync_vs", _in_tenant(_sync_vs_job))
 
+def enqueue_side_effects(user_id: Union[int, str], deferred: List[Tuple[str, dict]], deadline: Union[Deadline, None] = None):
+    if not deferred:
+        return
+    tenant = current_tenant.get()
+    tenant_payload = {"tenant": tenant.name} if tenant else {}
+    for kind, payload in deferred:
+        jobs.enqueue(kind, user_id, {**payload, **tenant_payload})
+    if breaker("vector_store").state == "open":
+        fallback("skip_stats_sync", "vector store breaker open")
+    elif deadline is not None and deadline.expired:
+        # ход уже вышел за бюджет — не добавляем нагрузки; следующий ход синхронизирует всё разом
+        fallback("skip_stats_sync", "turn budget exhausted")
+    else:
+        # синк VS читает stats.json в момент запуска — достаточно последнего на пользователя
+        jobs.enqueue("sync_vs", user_id, tenant_payload, coalesce=True)
+    deferred.clear()
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Пул готовых уроков (см. lesson_pool.py)
+# ─────────────────────────────────────────────────────────────────────────────
+lesson_pool = LessonPool()
+
+def produce_pool_lesson(level: str, ex_type: str):
+    """Генерирует одну заготовку для пула: (payload, путь к аудио) или None, если ответ не по схеме."""
+    request = (
+        f"Подготовь новое задание: уровень {level}, тип «{ex_type}». "
+        "Это заготовка для любого ученика: не опирайся на историю и статистику, "
+        "score = 0, stats — пустой массив."
+    )
+    raw = current_agent().complete_once(current_prompt(), request, RESPONSE_FORMAT)
     try:
-        # отправляем запрос ассистенту
-        # tg_user_id = update.effective_user.id
-        print("tg_user_id =", tg_user_id)
-        assistant_raw = await asyncio.to_thread(agent.send_message, chat_id, user_text_for_agent, tg_user_id=tg_user_id)
-
-        # Сначала попробуем прямой парсинг всего ответа (вдруг уже валиден)
-        try:
-            payload = json.loads(assistant_raw)
-            objects = [assistant_raw]
-        except Exception:
-            # Чиним распространённые баги формата
-            fixed = repair_common_json_glitches(assistant_raw)
-            # Пытаемся ещё раз целиком
-            try:
-                payload = json.loads(fixed)
-                objects = [fixed]
-            except Exception:
-                # Падаем на мульти-объекты: вытаскиваем каждый по балансировке скобок
-                objects = extract_json_objects(fixed)
+        payload = json.loads(repair_common_json_glitches(raw))
+    except Exception:
+        return None
+    if not validate_schema(payload, RESPONSE_FORMAT["json_schema"]["schema"]):
+        return None
+    if payload["Bot"]["level"] != level:
+        return None
+    audio_script = payload["Bot"]["audio_script"].strip()
+    audio_path = synth_dialogue(script_to_dialogue_list(audio_script)) if audio_script else None
+    return json.dumps(payload, ensure_ascii=False), audio_path
+
+async def serve_from_pool(update, user_text: str, chat_id: str, tg_user_id: Union[int, str], t_start: float) -> bool:
+    """Типовой запрос («дай аудирование N5») — ответ из пула без вызова модели. True, если обслужили."""
+    match = match_generic_request(user_text)
+    if not match:
+        return False
+    item = await run_blocking(current_pool().take, *match, tg_user_id)
+    if item is None:
+        metrics.incr("pool.miss")
+        return False
+    metrics.incr("pool.hit")
+    # модель должна видеть выданное задание в истории, чтобы проверить ответ ученика
+    await run_blocking(current_agent().append_turn, chat_id, user_text, item.payload)
+    # score/stats заготовки к ученику не относятся — побочные эффекты не сохраняем
+    await deliver_objects(update, [item.payload], tg_user_id, [], t_start, ready_audio=item.audio)
+    await flush_replies(update)
+    return True
 
-        if not objects:
-            await reply_student_text(update, assistant_raw[:MAX_TG_TEXT])
-            return
+# ─────────────────────────────────────────────────────────────────────────────
+# Готовое повторение дня (см. nightly_review.py)
+# ─────────────────────────────────────────────────────────────────────────────
+nightly_reviews: List[NightlyReview] = []
 
+def start_nightly_review():
+    """Ночной планировщик для текущего агента (тенанта); задача копирует контекст тенанта."""
+    if not REVIEW_ENABLED:
+        return
+    review = NightlyReview(current_agent(), current_prompt(), RESPONSE_FORMAT, abs_students_dir(),
+                           repair=repair_common_json_glitches)
+    review.start()
+    nightly_reviews.append(review)
+
+async def stop_nightly_reviews():
+    for review in nightly_reviews:
+        await review.stop()
+    nightly_reviews.clear()
+
+async def serve_review(update, user_text: str, chat_id: str, tg_user_id: Union[int, str], t_start: float) -> bool:
+    """Первое приветствие дня — ответ из повторения, подготовленного ночью. True, если обслужили."""
+    if not is_opening_message(user_text) or not should_inject_tech_stats_today(tg_user_id):
+        return False
+    student, day = student_dir(tg_user_id), today_utc()
+    payload = await run_blocking(take_review, student, day)
+    if payload is None:
+        metrics.incr("review.miss")
+        return False
+    metrics.incr("review.hit")
+    bot, chat = update.get_bot(), update.effective_chat.id
+    sent_before = sender.sent_count(bot, chat)
+    deferred: List[Tuple[str, dict]] = []
+    try:
+        await deliver_objects(update, [payload], tg_user_id, deferred, t_start)
+        await flush_replies(update)
+    except Exception as e:
+        # повторение не потрачено, техстатс не помечен — всё достанется следующему приветствию
+        await run_blocking(restore_review, student, day)
+        if sender.sent_count(bot, chat) == sent_before:
+            raise  # ученик ничего не получил — ход уйдёт в модель
+        # часть повторения уже у ученика: второй ответ от модели поверх него не шлём
+        print(f"[review] delivery failed after partial send: {e}")
+        await sender.send_plain(bot, chat, f"Ошибка: {e}")
+        return True
+    # техстатс уже учтён в повторении: сегодня его больше не прикладываем
+    mark_tech_stats_sent_now(tg_user_id)
+    await run_blocking(current_agent().append_turn, chat_id, user_text, payload)
+    # score в ночном ответе модель ставила без истории и текущего score — реальный не трогаем
+    enqueue_side_effects(tg_user_id, [(kind, p) for kind, p in deferred if kind != "save_score"])
+    return True
+
+async def _post_init(app: Application):
+    await jobs.start()
+    start_nightly_review()
+    lesson_pool.start_refill(produce_pool_lesson)
+
+async def _post_shutdown(app: Application):
+    await lesson_pool.stop_refill()
+    await stop_nightly_reviews()
+    await jobs.stop()
+    await asyncio.to_thread(profiler.stop)
+    if traffic_trace.recorder is not None:
+        traffic_trace.recorder.close()
 
-        # 2) обрабатываем все объекты по порядку
+# ─────────────────────────────────────────────────────────────────────────────
+# Доставка объектов ответа: текст — сразу, аудио — по готовности
+# ─────────────────────────────────────────────────────────────────────────────
+def _remove_audio_when_done(task: asyncio.Task):
+    """Если аудио так и не отправили (ошибка выше по стеку) — не оставляем файл на диске.
+    Для уже завершённой задачи колбэк срабатывает сразу."""
+    def _cleanup(t: asyncio.Task):
+        if not t.cancelled() and t.exception() is None:
+            with suppress(Exception):
+                os.remove(t.result())
+    task.add_done_callback(_cleanup)
+
+# исходный диалог всё равно покажем после ответа ученика (см. save_last_audio_script)
+AUDIO_DROPPED_NOTICE = "Аудио сейчас не успело подготовиться — текст диалога пришлю вместе с разбором ответа."
+
+async def _send_audio_task(update, task: Union[asyncio.Task, None], owned: Union[set, None] = None):
+    """owned — сюда попадает задача, файл которой этот вызов забрал (и сам удалит)."""
+    bot, chat = update.get_bot(), update.effective_chat.id
+    if task is None:
+        # синтез даже не запускали: бюджет хода исчерпан или TTS недоступен
+        await sender.send_plain(bot, chat, AUDIO_DROPPED_NOTICE)
+        return
+    try:
+        audio_path = await task
+    except DeadlineExceeded as e:
+        fallback("drop_audio", str(e))
+        await sender.send_plain(bot, chat, AUDIO_DROPPED_NOTICE)
+        return
+    except Exception as e:
+        print(f"TTS failed for chat {chat}: {e}")
+        await sender.send_plain(bot, chat, "Не удалось озвучить диалог, попробуй ещё раз позже.")
+        return
+    if owned is not None:
+        owned.add(task)
+    try:
+        await sender.send_dialogue_audio(bot, chat, audio_path)
+    finally:
+        # remove temporary audio file
+        with suppress(Exception):
+            os.remove(audio_path)
+
+def _synth_with_stage(dialogue: List[Dict[str, str]], deadline: Union[Deadline, None]) -> Path:
+    with traffic_trace.stage("tts"):
+        return synth_dialogue(dialogue, deadline=deadline)
+
+async def _ready_audio(path: Path) -> Path:
+    return path
+
+async def deliver_objects(
+    update,
+    objects: List[str],
+    tg_user_id: Union[int, str],
+    deferred: List[Tuple[str, dict]],
+    t_start: float,
+    ready_audio: Union[Path, None] = None,
+    deadline: Union[Deadline, None] = None,
+):
+    """
+    Проход 1: разбираем объекты, запускаем синтез ВСЕХ аудио сразу (в фоне) и готовим тексты.
+    Проход 2: отправляем в порядке AUDIO_ORDER:
+      - "text_first": все тексты немедленно, аудио — следом, по мере готовности (в порядке объектов);
+      - "strict": как раньше — аудио объекта перед его текстом (но синтез уже идёт параллельно).
+    ready_audio — уже озвученный диалог (урок из пула): синтез не нужен.
+    deadline — бюджет хода: мало времени — аудио не делаем (с уведомлением), strict → text_first.
+    """
+    # (текст, есть ли аудио, задача синтеза — None, если синтез не запускали)
+    turns: List[Tuple[str, bool, Union[asyncio.Task, None]]] = []
+    audio_tasks: List[Union[asyncio.Task, None]] = []
+    sent_tasks: set = set()  # файлы этих задач удаляет _send_audio_task
+    try:
         for obj_str in objects:
             try:
                 payload = json.loads(obj_str)
             except Exception:
                 # если вдруг один из кусочков битый — покажем как текст
-                await reply_student_text(update, obj_str[:MAX_TG_TEXT])
+                turns.append((obj_str[:MAX_TG_TEXT], False, None))
                 continue
 
             bot_data = payload.get("Bot") or {}
 
-            # сохраняем score / tech_stats / stats
+            # score / tech_stats / stats сохраняются в фоне, после отправки ответа
             if isinstance(bot_data.get("score"), int):
-                save_score(tg_user_id, int(bot_data["score"]))
+                level = bot_data.get("level") if isinstance(bot_data.get("level"), str) else None
+                deferred.append(("save_score", {"score": int(bot_data["score"]), "level": level}))
             if isinstance(bot_data.get("tech_stats"), str) and bot_data["tech_stats"].strip():
-                append_tech_stats(tg_user_id, bot_data["tech_stats"])
+                deferred.append(("append_tech_stats", {"tech_stats": bot_data["tech_stats"]}))
             stats_field = bot_data.get("stats")
             if isinstance(stats_field, list):
-                append_stats(tg_user_id, stats_field)
-            
-            try:
-                agent.sync_user_stats_to_vs(tg_user_id)
-            except Exception as e:
-                print(f"Failed to sync stats to VS for user {tg_user_id}: {e}")
+                deferred.append(("append_stats", {"stats": stats_field}))
 
-            # аудирование (если есть)
+            # аудирование (если есть) — синтез стартует сразу, не дожидаясь отправки текста
             audio_script = (bot_data.get("audio_script") or "").strip()
+            task: Union[asyncio.Task, None] = None
             if audio_script:
-                dialogue = script_to_dialogue_list(audio_script)
-                await update.message.chat.send_action(ChatAction.RECORD_VOICE)
-                audio_path = await asyncio.to_thread(synth_dialogue_to_mp3, dialogue)
-                await update.message.reply_audio(audio=open(audio_path, "rb"), title="Аудирование")
-                # remove temporary audio file
-                os.remove(audio_path)
-
+                if ready_audio is not None:
+                    task = asyncio.create_task(_ready_audio(ready_audio))
+                    ready_audio = None
+                elif deadline is not None and deadline.remaining() < AUDIO_MIN_BUDGET_S:
+                    fallback("drop_audio", f"{deadline.remaining():.1f}s left")
+                elif breaker("tts").state == "open":
+                    fallback("drop_audio", "tts breaker open")
+                else:
+                    dialogue = script_to_dialogue_list(audio_script)
+                    task = asyncio.create_task(run_blocking(_synth_with_stage, dialogue, deadline))
+                audio_tasks.append(task)
                 save_last_audio_script(tg_user_id, audio_script)
 
             # видимая часть для ученика
@@ -390,7 +549,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 student_text = strip_dialogue_from_student(student_text)
             # Если это уже не аудио-ответ (audio_script пуст),
             # и у нас есть «ожидание» показать исходный диалог — приложим его в конец Student
-            if not (bot_data.get("audio_script") or "").strip() and is_awaiting_dialog_dump(tg_user_id):
+            if not audio_script and is_awaiting_dialog_dump(tg_user_id):
                 last_script = load_last_audio_script(tg_user_id).strip()
                 if last_script:
                     # добавим аккуратно подзаголовок и диалог A:/B:
@@ -401,16 +560,271 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     student_text = (student_text or "") + addendum
                 clear_awaiting_dialog_dump(tg_user_id)
 
-            await reply_student_text(update, student_text if student_text else "Пустое поле Student.")
+            turns.append((student_text if student_text else "Пустое поле Student.", bool(audio_script), task))
+
+        first_sent = False
+
+        def mark_first():
+            nonlocal first_sent
+            if not first_sent:
+                first_sent = True
+                ttfm = time.monotonic() - t_start
+                metrics.observe("ttfm_s", ttfm)
+                print(f"[latency] user {tg_user_id}: time to first message {ttfm:.2f}s")
+
+        order = AUDIO_ORDER
+        if order == "strict" and audio_tasks and deadline is not None and deadline.remaining() < 2 * AUDIO_MIN_BUDGET_S:
+            # ждать аудио перед текстом уже дорого — текст сейчас, аудио потом
+            fallback("audio_later", f"{deadline.remaining():.1f}s left")
+            order = "text_first"
+
+        if order == "strict":
+            for text, has_audio, task in turns:
+                if has_audio:
+                    await flush_replies(update)
+                    await update.message.chat.send_action(ChatAction.RECORD_VOICE)
+                    await _send_audio_task(update, task, sent_tasks)
+                    mark_first()
+                await reply_student_text(update, text)
+            await flush_replies(update)
+            mark_first()
+        else:
+            for text, _, _ in turns:
+                await reply_student_text(update, text)
+            await flush_replies(update)
+            mark_first()
+            if audio_tasks:
+                await update.message.chat.send_action(ChatAction.RECORD_VOICE)
+            for task in audio_tasks:
+                await _send_audio_task(update, task, sent_tasks)
+    finally:
+        # и ещё идущие, и уже готовые, но не отправленные (упала отправка раньше них)
+        for task in audio_tasks:
+            if task is not None and task not in sent_tasks:
+                _remove_audio_when_done(task)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Telegram: единый обработчик текстовых сообщений (бот — прокси к ассистенту)
+# ─────────────────────────────────────────────────────────────────────────────
+# (тенант, chat_id) → [замок, сколько ходов его держит или ждёт]
+_chat_locks: Dict[Tuple[str, int], list] = {}
+
+@asynccontextmanager
+async def chat_turn(chat_id: int):
+    """
+    Ходы одного чата — строго по очереди, даже если тенант обрабатывает апдейты параллельно:
+    история чата, очередь исходящих sender и флаги в students/<id> рассчитаны на один ход за раз.
+    """
+    tenant = current_tenant.get()
+    key = (tenant.name if tenant else "", chat_id)
+    entry = _chat_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _chat_locks[key]
+
+async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message or not update.message.text:
+        return
+
+    traffic_trace.start_turn(update.effective_user.id, update.message.text.strip())
+    try:
+        async with chat_turn(update.effective_chat.id):
+            with traffic_trace.stage("total"):
+                await handle_text_message(update)
+    finally:
+        if traffic_trace.recorder is not None:
+            traffic_trace.recorder.flush()
+        # отчёт пишется в потоке: снимок tracemalloc не должен стопорить event loop;
+        # вне сессии — ни одного перехода в пул потоков
+        if profiler.active():
+            await asyncio.to_thread(profiler.note_message)
+
+async def on_prof(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Скрытая команда /prof для администраторов (см. profiler.py); остальным бот молчит."""
+    if not update.message or update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    try:
+        action, messages, seconds = profiler.parse_command(context.args or [])
+    except ValueError:
+        await sender.send_plain(update.get_bot(), update.effective_chat.id, "Использование: /prof N | Ns | stop | status")
+        return
+    if action == "start":
+        ok = profiler.start(messages=messages, seconds=seconds)
+        reply = "Профилирование запущено" if ok else f"Уже идёт: {profiler.status()}"
+    elif action == "stop":
+        out = await asyncio.to_thread(profiler.stop)
+        reply = f"Отчёт: {out}" if out else "Сессия не запущена"
+    else:
+        reply = profiler.status()
+    await sender.send_plain(update.get_bot(), update.effective_chat.id, reply)
+
+async def handle_text_message(update: Update):
+    t_start = time.monotonic()
+    deadline = Deadline(TURN_BUDGET_S)
+    user_text = update.message.text.strip()
+    tg_user_id: Union[int, str] = update.effective_user.id
+
+    # гарантируем чат для данного Telegram-пользователя
+    chat_id = await run_blocking(
+        current_agent().ensure_user_chat,
+        telegram_user_id=tg_user_id,
+        system_prompt=current_prompt(),
+        response_format=RESPONSE_FORMAT,
+        title=f"user:{tg_user_id}"
+    )
+
+    try:
+        if await serve_review(update, user_text, chat_id, tg_user_id, t_start):
+            return
+    except Exception as e:
+        print(f"[review] serve failed, falling back to model: {e}")
+
+    try:
+        if await serve_from_pool(update, user_text, chat_id, tg_user_id, t_start):
+            return
+    except Exception as e:
+        print(f"[pool] serve failed, falling back to model: {e}")
 
+    # раз в день прикладываем tech_stats к запросу в ассистента
+    user_text_for_agent = inject_daily_tech_stats(user_text, tg_user_id)
+
+    await update.message.chat.send_action(ChatAction.TYPING)
+
+    deferred: List[Tuple[str, dict]] = []
+    try:
+        # отправляем запрос ассистенту
+        # tg_user_id = update.effective_user.id
+        print("tg_user_id =", tg_user_id)
+        with traffic_trace.stage("model"):
+            assistant_raw = await run_blocking(
+                current_agent().send_message, chat_id, user_text_for_agent, tg_user_id=tg_user_id, deadline=deadline
+            )
+
+        with traffic_trace.stage("parse"):
+            objects = parse_assistant_objects(assistant_raw)
+
+        if not objects:
+            await reply_student_text(update, assistant_raw[:MAX_TG_TEXT])
+            await flush_replies(update)
+            metrics.observe("ttfm_s", time.monotonic() - t_start)
+            return
+
+
+        # 2) обрабатываем все объекты: текст уходит сразу, аудио синтезируется параллельно
+        with traffic_trace.stage("deliver"):
+            await deliver_objects(update, objects, tg_user_id, deferred, t_start, deadline=deadline)
+
+        await flush_replies(update)
+        enqueue_side_effects(tg_user_id, deferred, deadline)
 
     except Exception as e:
-        await update.message.reply_text(f"Ошибка: {e}")
+        if isinstance(e, DeadlineExceeded):
+            fallback("turn_timeout", str(e))
+        # то, что успели подготовить до ошибки, всё равно доставляем и сохраняем
+        with suppress(Exception):
+            await flush_replies(update)
+        enqueue_side_effects(tg_user_id, deferred, deadline)
+        await sender.send_plain(update.get_bot(), update.effective_chat.id, f"Ошибка: {e}")
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Несколько ботов в одном процессе (TENANTS_PATH)
+# ─────────────────────────────────────────────────────────────────────────────
+def make_tenant_handler(tenant: Tenant):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        current_tenant.set(tenant)
+        await on_message(update, context)
+    return handler
+
+def build_tenant_app(tenant: Tenant) -> Application:
+    builder = (
+        Application.builder()
+        .token(tenant.token)
+        # квота тенанта: не больше max_concurrency ходов одновременно, остальные ждут в его очереди;
+        # ходы одного чата при этом идут по очереди (chat_turn), блокирующие вызовы — в пул тенанта
+        .concurrent_updates(tenant.max_concurrency)
+    )
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, make_tenant_handler(tenant)))
+    app.add_handler(CommandHandler("prof", on_prof))
+    return app
+
+async def run_tenants(tenants: List[Tenant]):
+    apps = {t.name: build_tenant_app(t) for t in tenants}
+    await jobs.start()
+    for t in tenants:
+        # задача пополнения копирует контекст — тенант «прилипает» к ней
+        current_tenant.set(t)
+        t.lesson_pool.start_refill(produce_pool_lesson)
+        start_nightly_review()
+    current_tenant.set(None)
+    try:
+        if BOT_MODE == "webhook":
+            from webhook import serve_webhook
+            base_path, base_url = WEBHOOK_PATH.rstrip("/"), WEBHOOK_URL.rstrip("/")
+            await serve_webhook({
+                f"{base_path}/{name}": (app, f"{base_url}/{name}" if base_url else "")
+                for name, app in apps.items()
+            })
+        else:
+            await _poll_all(list(apps.values()))
+    finally:
+        for t in tenants:
+            await t.lesson_pool.stop_refill()
+        await stop_nightly_reviews()
+        await jobs.stop()
+        await asyncio.to_thread(profiler.stop)
+        if traffic_trace.recorder is not None:
+            traffic_trace.recorder.close()
+        shutdown_executors()
+
+async def _poll_all(apps: List[Application]):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+    for app in apps:
+        await app.initialize()
+        await app.start()
+        await app.updater.start_polling()
+    try:
+        await stop_event.wait()
+    finally:
+        for app in apps:
+            await app.updater.stop()
+            await app.stop()
+            await app.shutdown()
 
 def run():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if TENANTS_PATH:
+        asyncio.run(run_tenants(load_tenants(Path(TENANTS_PATH))))
+        return
+
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+    )
+    if BOT_MODE == "webhook":
+        # апдейты приходят через HTTP-фронт, Updater (getUpdates) не нужен
+        builder = builder.updater(None)
+    app = builder.build()
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message))
-    app.run_polling()
+    app.add_handler(CommandHandler("prof", on_prof))
+
+    if BOT_MODE == "webhook":
+        from webhook import serve_webhook
+        asyncio.run(serve_webhook({WEBHOOK_PATH: (app, WEBHOOK_URL)}))
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,41 @@
+"""
+Простые in-process метрики: счётчики и последние N замеров по имени.
+Снимок отдаётся в /health webhook-сервера и печатается в логах.
+"""
+from collections import defaultdict, deque
+from typing import Deque, Dict
+
+
+WINDOW = 1000  # сколько последних замеров держим на метрику
+
+_counters: Dict[str, int] = defaultdict(int)
+_timings: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=WINDOW))
+
+
+def incr(name: str, n: int = 1):
+    _counters[name] += n
+
+
+def observe(name: str, value: float):
+    _timings[name].append(value)
+
+
+def _quantile(sorted_vals, q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(q * len(sorted_vals)))
+    return sorted_vals[idx]
+
+
+def snapshot() -> dict:
+    # observe()/incr() зовут и из рабочих потоков — итерируем копии, а не живые словари
+    timings = {}
+    for name, vals in list(_timings.items()):
+        s = sorted(list(vals))
+        timings[name] = {
+            "count": len(s),
+            "p50": round(_quantile(s, 0.5), 4),
+            "p95": round(_quantile(s, 0.95), 4),
+            "max": round(s[-1], 4) if s else 0.0,
+        }
+    return {"counters": dict(list(_counters.items())), "timings": timings}
@@ -0,0 +1,375 @@
+# app/nightly_review.py
+"""
+Ночная пакетная подготовка персонального повторения.
+
+Раньше первое сообщение дня было самым медленным: inject_daily_tech_stats прикладывал
+к нему техстатс, и модель на лету собирала повторение. Теперь ночью (REVIEW_HOURS_UTC):
+  1. по индексу (student_index.py) выбираются ученики, активные за REVIEW_ACTIVE_DAYS;
+  2. из их tech_stats_latest.txt и хвоста stats.json строятся запросы на повторение;
+  3. запросы уходят одним пакетом в batch-бэкенд:
+       "openai" — OpenAI Batch API (/v1/responses, окно 24h, дешевле онлайн-вызовов);
+       "local"  — локальная замена: те же запросы выполняются по одному (для отладки и тестов);
+  4. ответы, прошедшие проверку схемы, кладутся в students/<id>/review/<YYYY-MM-DD>.json.
+
+Первое приветственное сообщение дня (см. is_opening_message) обслуживается из готового
+повторения без вызова модели; конкретный вопрос ученика по-прежнему идёт в модель.
+
+Состояние пакета (students/_nightly.json) переживает рестарт: отправленный пакет
+дожидается, а не отправляется заново.
+
+CLI (из app/):
+  python nightly_review.py run [--day 2025-01-31] [--backend local]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import tempfile
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from config import (
+    REVIEW_BATCH_BACKEND, REVIEW_HOURS_UTC, REVIEW_ACTIVE_DAYS, REVIEW_STATS_LINES,
+    REVIEW_POLL_SEC, REVIEW_CHECK_SEC,
+)
+from lesson_pool import validate_schema, _in_hours
+from openai_client import ChatGPTAgent, OPENAI_TEXT_MODEL, client
+
+
+REVIEW_SUBDIR = "review"
+STATE_FILE = "_nightly.json"
+INDEX_PAGE = 1000
+
+RE_OPENING = re.compile(
+    r"^\s*(?:привет\w*|здравствуй\w*|добр\w+\s+(?:утро|день|вечер)|hi|hello|hey|start|/start|"
+    r"начн[её]м|поехали|давай\w*|ohayou?|konnichiwa|おはよう\w*|こんにちは|こんばんは)\W*$",
+    re.IGNORECASE,
+)
+
+
+def today_utc() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def is_opening_message(text: str) -> bool:
+    """Приветствие / «начнём» — на него уместно ответить готовым повторением."""
+    return bool(RE_OPENING.match(text or ""))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Хранение готовых повторений
+# ─────────────────────────────────────────────────────────────────────────────
+def review_path(student: Path, day: str) -> Path:
+    return student / REVIEW_SUBDIR / f"{day}.json"
+
+
+def store_review(student: Path, day: str, payload: str):
+    p = review_path(student, day)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_suffix(".tmp")
+    tmp.write_text(json.dumps({
+        "day": day,
+        "created_at_utc": datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
+        "payload": payload,
+    }, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, p)
+
+
+def take_review(student: Path, day: str) -> Optional[str]:
+    """Забирает повторение на день (один раз: файл переименовывается в .served.json)."""
+    p = review_path(student, day)
+    served = p.with_name(f"{day}.served.json")
+    try:
+        os.replace(p, served)  # атомарно: два одновременных хода не получат одно повторение
+    except FileNotFoundError:
+        return None
+    try:
+        return json.loads(served.read_text(encoding="utf-8"))["payload"]
+    except (OSError, json.JSONDecodeError, KeyError):
+        return None
+
+
+def restore_review(student: Path, day: str):
+    """Возвращает забранное повторение (доставка не удалась) — его подадут на следующее приветствие."""
+    p = review_path(student, day)
+    served = p.with_name(f"{day}.served.json")
+    if served.exists() and not p.exists():
+        os.replace(served, p)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Запросы
+# ─────────────────────────────────────────────────────────────────────────────
+def _tail_lines(p: Path, n: int) -> str:
+    if not p.exists():
+        return ""
+    lines = p.read_text(encoding="utf-8").splitlines()
+    return "\n".join(lines[-n:])
+
+
+def build_review_request(
+    agent: ChatGPTAgent, system_prompt: str, response_format: dict, student: Path, uid: str, day: str
+) -> Optional[dict]:
+    """Тело запроса к Responses API для одного ученика; None — статистики нет, готовить не из чего."""
+    tech = (student / "tech_stats_latest.txt")
+    tech_stats = tech.read_text(encoding="utf-8").strip() if tech.exists() else ""
+    stats = _tail_lines(student / "stats.json", REVIEW_STATS_LINES)
+    if not tech_stats and not stats:
+        return None
+
+    request = (
+        f"[NIGHTLY_REVIEW {day}]\n"
+        "Подготовь первое сообщение дня для этого ученика: короткое приветствие и повторение "
+        "по его статистике — слабые места и недавний материал, одно задание на повторение. "
+        "Ученик увидит это в ответ на приветствие. stats — пустой массив."
+    )
+    if tech_stats:
+        request += f"\n\n[BOT_TECH_STATS_UTC]\n{tech_stats}"
+    if stats:
+        request += f"\n\n[STATS]\n{stats}"
+
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages.append({"role": "user", "content": request})
+    body = {"model": OPENAI_TEXT_MODEL, "input": agent.with_schema_instruction(messages, response_format)}
+    # в пакете векторку не создаём: только уже существующая персональная + общая
+    vs_ids = [v for v in ((agent.users.get(uid) or {}).get("vector_store_id"), agent.global_vector_store_id) if v]
+    if vs_ids:
+        body["tools"] = [{"type": "file_search", "vector_store_ids": vs_ids}]
+    return body
+
+
+def _response_text(body: dict) -> str:
+    """output_text из сырого JSON ответа Responses API (в пакете нет удобного поля SDK)."""
+    chunks = []
+    for out in body.get("output") or []:
+        if out.get("type") == "message":
+            for item in out.get("content") or []:
+                if item.get("type") == "output_text":
+                    chunks.append(item.get("text", ""))
+    return "\n".join(chunks).strip()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Batch-бэкенды
+# ─────────────────────────────────────────────────────────────────────────────
+class OpenAIBatchBackend:
+    name = "openai"
+
+    def submit(self, requests: Dict[str, dict]) -> str:
+        lines = [
+            json.dumps({"custom_id": cid, "method": "POST", "url": "/v1/responses", "body": body}, ensure_ascii=False)
+            for cid, body in requests.items()
+        ]
+        with tempfile.NamedTemporaryFile("w", delete=False, suffix=".jsonl", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        try:
+            with open(f.name, "rb") as fh:
+                up = client.files.create(file=fh, purpose="batch")
+        finally:
+            os.remove(f.name)
+        batch = client.batches.create(input_file_id=up.id, endpoint="/v1/responses", completion_window="24h")
+        return batch.id
+
+    def poll(self, batch_id: str) -> Optional[Dict[str, str]]:
+        """None — пакет ещё в работе; иначе custom_id → текст ответа (неудачные пропущены)."""
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+            return None
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"[review] batch {batch_id} ended with status {batch.status}")
+            return {}
+        results: Dict[str, str] = {}
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            resp = rec.get("response") or {}
+            if resp.get("status_code") == 200:
+                results[rec["custom_id"]] = _response_text(resp.get("body") or {})
+        return results
+
+
+class LocalBatchBackend:
+    """
+    Локальная замена Batch API: запросы сохраняются в файл и выполняются по одному при poll.
+    run_fn(body) -> текст ответа; по умолчанию — обычный онлайн-вызов Responses API.
+    """
+    name = "local"
+
+    def __init__(self, base: Path, run_fn: Optional[Callable[[dict], str]] = None):
+        self.base = Path(base) / "local_batches"
+        self.run_fn = run_fn or self._online
+
+    @staticmethod
+    def _online(body: dict) -> str:
+        resp = client.responses.create(**body)
+        return getattr(resp, "output_text", "").strip()
+
+    def submit(self, requests: Dict[str, dict]) -> str:
+        self.base.mkdir(parents=True, exist_ok=True)
+        batch_id = f"local_{uuid.uuid4().hex[:12]}"
+        (self.base / f"{batch_id}.json").write_text(json.dumps(requests, ensure_ascii=False), encoding="utf-8")
+        return batch_id
+
+    def poll(self, batch_id: str) -> Optional[Dict[str, str]]:
+        p = self.base / f"{batch_id}.json"
+        if not p.exists():
+            return {}
+        results: Dict[str, str] = {}
+        for cid, body in json.loads(p.read_text(encoding="utf-8")).items():
+            try:
+                results[cid] = self.run_fn(body)
+            except Exception as e:
+                print(f"[review] local request {cid} failed: {e}")
+        p.unlink()
+        return results
+
+
+def make_backend(name: str, base: Path):
+    if name == "local":
+        return LocalBatchBackend(base)
+    return OpenAIBatchBackend()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Ночной прогон
+# ─────────────────────────────────────────────────────────────────────────────
+class NightlyReview:
+    def __init__(
+        self,
+        agent: ChatGPTAgent,
+        system_prompt: str,
+        response_format: dict,
+        students_dir: Path,
+        backend=None,
+        repair: Callable[[str], str] = lambda raw: raw,
+        poll_interval: float = REVIEW_POLL_SEC,
+    ):
+        self.agent = agent
+        self.system_prompt = system_prompt
+        self.response_format = response_format
+        self.students_dir = Path(students_dir)
+        self.backend = backend or make_backend(REVIEW_BATCH_BACKEND, self.students_dir)
+        self.repair = repair  # починка JSON ответа, та же, что в онлайн-ходе
+        self.poll_interval = poll_interval
+        self.state_path = self.students_dir / STATE_FILE
+        self._task: Optional[asyncio.Task] = None
+
+    # ----- состояние -----
+
+    def _load_state(self) -> dict:
+        try:
+            return json.loads(self.state_path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _save_state(self, **state):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.state_path.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+
+    # ----- шаги -----
+
+    def active_students(self, day: str) -> List[str]:
+        since = (date.fromisoformat(day) - timedelta(days=REVIEW_ACTIVE_DAYS)).isoformat()
+        uids, offset = [], 0
+        while True:
+            page = self.agent.query_students(active_since=since, order="chat_id", desc=False,
+                                             limit=INDEX_PAGE, offset=offset)
+            uids += [r["chat_id"] for r in page]
+            if len(page) < INDEX_PAGE:
+                return uids
+            offset += INDEX_PAGE
+
+    def prepare(self, day: str) -> Dict[str, dict]:
+        requests: Dict[str, dict] = {}
+        for uid in self.active_students(day):
+            student = self.students_dir / uid
+            if review_path(student, day).exists():
+                continue
+            body = build_review_request(self.agent, self.system_prompt, self.response_format, student, uid, day)
+            if body is not None:
+                requests[uid] = body
+        return requests
+
+    def store(self, day: str, results: Dict[str, str]) -> int:
+        schema = self.response_format["json_schema"]["schema"]
+        stored = 0
+        for uid, raw in results.items():
+            try:
+                payload = json.loads(self.repair(raw))
+            except Exception:
+                continue
+            if not validate_schema(payload, schema):
+                continue
+            store_review(self.students_dir / uid, day, json.dumps(payload, ensure_ascii=False))
+            stored += 1
+        return stored
+
+    async def run(self, day: Optional[str] = None) -> int:
+        """Подготовка повторений на день: отправка пакета (или продолжение отправленного) и сбор ответов."""
+        day = day or today_utc()
+        state = self._load_state()
+        if state.get("day") == day and state.get("state") == "done":
+            return 0
+        if state.get("day") == day and state.get("state") == "submitted" and state.get("backend") == self.backend.name:
+            batch_id = state["batch_id"]
+        else:
+            requests = await asyncio.to_thread(self.prepare, day)
+            if not requests:
+                self._save_state(day=day, state="done", stored=0)
+                return 0
+            batch_id = await asyncio.to_thread(self.backend.submit, requests)
+            self._save_state(day=day, state="submitted", backend=self.backend.name, batch_id=batch_id)
+            print(f"[review] submitted {len(requests)} requests for {day} as {batch_id}")
+
+        while True:
+            results = await asyncio.to_thread(self.backend.poll, batch_id)
+            if results is not None:
+                break
+            await asyncio.sleep(self.poll_interval)
+        stored = await asyncio.to_thread(self.store, day, results)
+        self._save_state(day=day, state="done", backend=self.backend.name, batch_id=batch_id, stored=stored)
+        print(f"[review] {day}: stored {stored} of {len(results)} reviews")
+        return stored
+
+    # ----- расписание (как пополнение пула уроков) -----
+
+    async def _loop(self, hours: str, interval: float):
+        while True:
+            if _in_hours(hours, datetime.now(timezone.utc).hour):
+                try:
+                    await self.run()
+                except Exception as e:
+                    print(f"[review] nightly run failed: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self, hours: str = REVIEW_HOURS_UTC, interval: float = REVIEW_CHECK_SEC):
+        self._task = asyncio.create_task(self._loop(hours, interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ночная подготовка повторений")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_run = sub.add_parser("run")
+    p_run.add_argument("--day", default=None, help="YYYY-MM-DD (UTC), по умолчанию сегодня")
+    p_run.add_argument("--backend", choices=["openai", "local"], default=REVIEW_BATCH_BACKEND)
+    args = parser.parse_args()
+
+    import main as bot  # промпт, схема ответа, агент и папка учеников — как у бота
+    students = bot.abs_students_dir()
+    review = NightlyReview(bot.agent, bot.SYSTEM_PROMPT, bot.RESPONSE_FORMAT, students,
+                           backend=make_backend(args.backend, students), repair=bot.repair_common_json_glitches)
+    asyncio.run(review.run(args.day))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,17 @@ from pathlib import Path
 import uuid
 import json
 import os
+import threading
+import time
 from dotenv import dotenv_values
 
+from config import FILE_SEARCH_MIN_BUDGET_S, HISTORY_COMPRESSION, HISTORY_WINDOW
+from deadline import Deadline, DeadlineExceeded, breaker, fallback
+from history_store import encode_turn, decode_turn, hydrate_history, json_default
+import traffic_trace
+from profiler import profiled
+from student_index import StudentIndex, index_path_for
+
 
 
 secrets: dict = dotenv_values(".env")
@@ -18,39 +27,53 @@ STUDENTS_DIR = secrets.get("STUDENTS_DIR", "students")
 client = OpenAI(api_key=OPENAI_API_KEY)
 
 
-def _abs_students_dir() -> Path:
+def _abs_students_dir(students_dir: str = STUDENTS_DIR) -> Path:
     # базируемся от корня проекта (где лежат твои .py)
     # если запускаешь из другого cwd — Path(__file__) защитит
     project_root = Path(__file__).resolve().parents[1]  # подними на уровень выше, если файлы в app/
-    return (project_root / STUDENTS_DIR).resolve()
+    return (project_root / students_dir).resolve()
 
 
 class ChatGPTAgent:
-    def __init__(self, chats_path: str = "./chats.json"):
+    def __init__(self, chats_path: str = "./chats.json", students_dir: str = STUDENTS_DIR):
         # openai_api_key оставлен для совместимости интерфейса
         self.chats_path = chats_path
+        self.students_dir = students_dir
+        # chats/users меняются и из event loop, и из потоков ходов; json.dump обходит весь словарь —
+        # мутации и сохранение под одним (реентерабельным) замком
+        self._lock = threading.RLock()
+        # метаданные пользователей (vector store и т.п.) — отдельный файл, не в пространстве чатов
+        p = Path(chats_path)
+        self.users_path = str(p.with_name(f"{p.stem}.users.json"))
+        self.users: Dict[str, Dict] = self._load_users()
         self.chats = self._load_chats()
         self.client = client
         self.vector_store_id = secrets.get("VECTOR_STORE_ID")
         self.global_vector_store_id = secrets.get("VECTOR_STORE_ID")
+        # вторичный индекс для админских запросов (student_index.py)
+        self.index = StudentIndex(index_path_for(chats_path))
+        if self.index.count() != len(self.chats):
+            self.rebuild_index()
 
 
     # --- Персональная векторка по юзеру ---
 
     def _student_dir(self, tg_user_id: Union[int, str]) -> Path:
-        p = _abs_students_dir() / str(tg_user_id)
+        p = _abs_students_dir(self.students_dir) / str(tg_user_id)
         p.mkdir(parents=True, exist_ok=True)
         return p
 
     def _get_or_create_user_vs(self, tg_user_id: Union[int, str]) -> str:
         uid = str(tg_user_id)
-        meta = self.chats.setdefault("__users__", {})
+        meta = self.users
         if uid in meta and meta[uid].get("vector_store_id"):
             return meta[uid]["vector_store_id"]
 
         vs = self.client.vector_stores.create(name=f"jp_teacher_student_{uid}")
-        meta[uid] = {"vector_store_id": vs.id}
-        self._save_chats()
+        with self._lock:
+            meta[uid] = {"vector_store_id": vs.id}
+            self._save_users()
+        self.index.upsert(uid, vector_store_id=vs.id)
         return vs.id
 
     def _upload_single_file_to_vs(self, vs_id: str, file_path: Path):
@@ -99,15 +122,51 @@ class ChatGPTAgent:
     def _load_chats(self) -> Dict[str, Dict]:
         if os.path.exists(self.chats_path):
             with open(self.chats_path, "r", encoding="utf-8") as f:
+                try:
+                    chats = json.load(f)
+                except json.JSONDecodeError:
+                    return {}
+            legacy_users = chats.pop("__users__", None)
+            for cdata in chats.values():
+                if isinstance(cdata, dict):
+                    hydrate_history(cdata.get("history", []))
+            if isinstance(legacy_users, dict):
+                # миграция: раньше метаданные пользователей лежали внутри chats.json
+                for uid, meta in legacy_users.items():
+                    self.users.setdefault(uid, meta)
+                self._save_users()
+                self.chats = chats
+                self._save_chats()
+            return chats
+        return {}
+
+    def _load_users(self) -> Dict[str, Dict]:
+        if os.path.exists(self.users_path):
+            with open(self.users_path, "r", encoding="utf-8") as f:
                 try:
                     return json.load(f)
                 except json.JSONDecodeError:
                     return {}
         return {}
 
+    def _save_users(self):
+        with self._lock, open(self.users_path, "w", encoding="utf-8") as f:
+            json.dump(self.users, f, ensure_ascii=False, indent=2)
+
+    def rebuild_index(self):
+        self.index.rebuild(self.chats, self.users, _abs_students_dir(self.students_dir))
+
+    @profiled("_save_chats")
     def _save_chats(self):
-        with open(self.chats_path, "w", encoding="utf-8") as f:
-            json.dump(self.chats, f, ensure_ascii=False, indent=2)
+        with self._lock, open(self.chats_path, "w", encoding="utf-8") as f:
+            json.dump(self.chats, f, ensure_ascii=False, indent=2, default=json_default)
+
+    @staticmethod
+    def _make_turn(role: str, content: str) -> Dict:
+        """Ход для хранения в истории: сжатый (HISTORY_COMPRESSION) или как есть."""
+        if HISTORY_COMPRESSION:
+            return encode_turn(role, content)
+        return {"role": role, "content": content}
 
     def create_chat(
         self,
@@ -134,18 +193,20 @@ class ChatGPTAgent:
         """
         if chat_id is None:
             chat_id = str(uuid.uuid4())
-        if chat_id in self.chats:
-            raise ValueError(f"Чат с id {chat_id} уже существует!")
-
-        self.chats[chat_id] = {
-            "title": title,
-            "description": description,
-            "system_prompt": system_prompt or "",
-            "response_format": response_format or None,
-            "history": [],
-            "vector_store_id": self.vector_store_id
-        }
-        self._save_chats()
+        with self._lock:
+            if chat_id in self.chats:
+                raise ValueError(f"Чат с id {chat_id} уже существует!")
+
+            self.chats[chat_id] = {
+                "title": title,
+                "description": description,
+                "system_prompt": system_prompt or "",
+                "response_format": response_format or None,
+                "history": [],
+                "vector_store_id": self.vector_store_id
+            }
+            self._save_chats()
+        self.index.upsert(chat_id, title=title, description=description, turns=0)
         print(f"Создан чат с id: {chat_id}, title: '{title}'")
         return chat_id
 
@@ -163,61 +224,55 @@ class ChatGPTAgent:
         Возвращает chat_id (строка с самим user_id).
         """
         chat_id = str(telegram_user_id)
-        if chat_id not in self.chats:
-            return self.create_chat(
-                chat_id=chat_id,
-                title=title or f"user:{chat_id}",
-                description=description,
-                system_prompt=system_prompt,
-                response_format=response_format
-            )
+        with self._lock:
+            if chat_id not in self.chats:
+                return self.create_chat(
+                    chat_id=chat_id,
+                    title=title or f"user:{chat_id}",
+                    description=description,
+                    system_prompt=system_prompt,
+                    response_format=response_format
+                )
         return chat_id
 
     def delete_chat(self, chat_id: str):
-        if chat_id in self.chats:
-            del self.chats[chat_id]
-            self._save_chats()
+        with self._lock:
+            found = self.chats.pop(chat_id, None) is not None
+            if found:
+                self._save_chats()
+        if found:
+            self.index.delete(chat_id)
             print(f"Чат {chat_id} удалён.")
         else:
             print(f"Чат {chat_id} не найден.")
 
     def get_chat_history(self, chat_id: str) -> Optional[List[Dict[str, str]]]:
         chat = self.chats.get(chat_id)
-        return chat["history"] if chat else None
-
-    def list_chats(self) -> List[Dict[str, str]]:
-        """Вернуть список чатов с их id, title и description."""
-        return [
-            {
-                "chat_id": cid,
-                "title": cdata.get("title", ""),
-                "description": cdata.get("description", "")
-            }
-            for cid, cdata in self.chats.items()
-        ]
-
-    def search_chats(self, query: str) -> List[Dict[str, str]]:
-        """Поиск по chat_id / title / description."""
-        results = []
-        query_lower = query.lower()
-        for cid, cdata in self.chats.items():
-            title = cdata.get("title", "")
-            desc = cdata.get("description", "")
-            if (query_lower in cid.lower() or
-                query_lower in title.lower() or
-                query_lower in desc.lower()):
-                results.append({
-                    "chat_id": cid,
-                    "title": title,
-                    "description": desc
-                })
-        return results
+        return [decode_turn(t) for t in chat["history"]] if chat else None
+
+    def list_chats(self, limit: int = -1, offset: int = 0) -> List[Dict[str, str]]:
+        """Вернуть список чатов с их id, title и description (по индексу, постранично)."""
+        rows = self.index.query(order="chat_id", desc=False, limit=limit, offset=offset)
+        return [{"chat_id": r["chat_id"], "title": r["title"], "description": r["description"]} for r in rows]
+
+    def search_chats(self, query: str, limit: int = -1, offset: int = 0) -> List[Dict[str, str]]:
+        """Поиск по chat_id / title / description (по индексу, постранично)."""
+        rows = self.index.query(text=query, order="chat_id", desc=False, limit=limit, offset=offset)
+        return [{"chat_id": r["chat_id"], "title": r["title"], "description": r["description"]} for r in rows]
+
+    def query_students(self, **filters) -> List[Dict]:
+        """Фильтрованный постраничный запрос по индексу: см. StudentIndex.query."""
+        return self.index.query(**filters)
 
     def clear_chat_history(self, chat_id: str):
         """Очистить историю чата без удаления чата."""
-        if chat_id in self.chats:
-            self.chats[chat_id]["history"] = []
-            self._save_chats()
+        with self._lock:
+            found = chat_id in self.chats
+            if found:
+                self.chats[chat_id]["history"] = []
+                self._save_chats()
+        if found:
+            self.index.upsert(chat_id, turns=0)
             print(f"История чата {chat_id} очищена.")
         else:
             print(f"Чат {chat_id} не найден.")
@@ -246,7 +301,8 @@ class ChatGPTAgent:
             if response_format:
                 f.write("=== RESPONSE FORMAT ===\n")
                 f.write(json.dumps(response_format, ensure_ascii=False, indent=2) + "\n\n")
-            for msg in history:
+            for turn in history:
+                msg = decode_turn(turn)
                 f.write(f"{msg['role'].upper()}: {msg['content']}\n\n")
 
         print(f"Чат {chat_id} экспортирован в {filename}")
@@ -262,13 +318,32 @@ class ChatGPTAgent:
                             chunks.append(item.text)
         return "\n".join(chunks).strip()
 
+    @staticmethod
+    def with_schema_instruction(messages: List[Dict[str, str]], response_format: Optional[dict] = None) -> List[Dict[str, str]]:
+        """Инжект схемы как system-инструкции (без response_format аргумента)."""
+        input_messages = list(messages)
+        if response_format and isinstance(response_format, dict):
+            if response_format.get("type") == "json_schema" and "json_schema" in response_format:
+                try:
+                    schema_text = json.dumps(response_format["json_schema"], ensure_ascii=False)
+                except Exception:
+                    schema_text = str(response_format["json_schema"])
+                schema_instruction = (
+                    "You MUST return a single JSON object that VALIDATES against the following JSON Schema. "
+                    "Return ONLY the raw JSON (no code fences, no extra text, no markdown):\n"
+                    f"{schema_text}"
+                )
+                input_messages = [{"role": "system", "content": schema_instruction}] + input_messages
+        return input_messages
+
     def _responses_api_call(
         self,
         model: str,
         messages: List[Dict[str, str]],
         response_format: Optional[dict] = None,
         # vector_store_id: Optional[str] = None,
-        vector_store_ids: list[str] | None = None
+        vector_store_ids: list[str] | None = None,
+        deadline: Optional[Deadline] = None
     ) -> str:
         """
         Вызов OpenAI Responses API с кросс-совместимостью:
@@ -276,41 +351,70 @@ class ChatGPTAgent:
         2) Если не прошло — ретраем старым способом:
         tools=[{"type":"file_search"}] + attachments на последнем user-сообщении.
         JSON-схему (если есть) инжектим в отдельный system-инструктаж.
+        deadline: при малом остатке бюджета или открытом предохранителе file_search
+        идём без векторки и без ретрая старым способом.
         """
-        input_messages = list(messages)
-
-        # Инжект схемы как system-инструкции (без response_format аргумента)
-        if response_format and isinstance(response_format, dict):
-            if response_format.get("type") == "json_schema" and "json_schema" in response_format:
-                try:
-                    schema_text = json.dumps(response_format["json_schema"], ensure_ascii=False)
-                except Exception:
-                    schema_text = str(response_format["json_schema"])
-                schema_instruction = (
-                    "You MUST return a single JSON object that VALIDATES against the following JSON Schema. "
-                    "Return ONLY the raw JSON (no code fences, no extra text, no markdown):\n"
-                    f"{schema_text}"
-                )
-                input_messages = [{"role": "system", "content": schema_instruction}] + input_messages
+        input_messages = self.with_schema_instruction(messages, response_format)
 
         # Попробуем VS из аргумента или из self/chats
         # vs_id = vector_store_id or getattr(self, "vector_store_id", None)
         vs_ids = vector_store_ids or []
+        if vs_ids and deadline is not None and deadline.remaining() < FILE_SEARCH_MIN_BUDGET_S:
+            fallback("skip_file_search", f"{deadline.remaining():.1f}s left")
+            vs_ids = []
+        if vs_ids and not breaker("file_search").allow():
+            fallback("skip_file_search", "breaker open")
+            vs_ids = []
+
+        model_breaker = breaker("responses")
+        if not model_breaker.allow():
+            raise RuntimeError("Модель временно недоступна, попробуй через минуту.")
+
+        def _create(**kwargs):
+            api = client
+            if deadline is not None:
+                deadline.check("responses")
+                # без ретраев SDK: иначе один вызов мог длиться до трёх остатков бюджета
+                api = client.with_options(timeout=deadline.timeout(), max_retries=0)
+            traffic_trace.record(
+                "model_request",
+                model=model,
+                n_messages=len(kwargs["input"]),
+                chars=sum(len(str(m.get("content", ""))) for m in kwargs["input"]),
+                tools=[t.get("type") for t in kwargs.get("tools", [])],
+            )
+            t0 = time.perf_counter()
+            try:
+                resp = api.responses.create(model=model, **kwargs)
+            except Exception as e:
+                model_breaker.record_failure()
+                traffic_trace.record("model_response", ok=False, error=str(e), dur=round(time.perf_counter() - t0, 4))
+                raise
+            model_breaker.record_success()
+            text = getattr(resp, "output_text", "").strip() or _collect_output_chunks(resp)
+            traffic_trace.record("model_response", ok=True, text=text, dur=round(time.perf_counter() - t0, 4))
+            return text
+
         if not vs_ids:
             # без векторки — обычный вызов
-            resp = client.responses.create(model=model, input=input_messages)
-            return getattr(resp, "output_text", "").strip() or _collect_output_chunks(resp)
+            return _create(input=input_messages)
 
         # === Попытка A: современный формат tools с vector_store_ids на самом tool ===
         try:
-            resp = client.responses.create(
-                model=model,
+            text = _create(
                 input=input_messages,
                 tools=[{"type": "file_search", "vector_store_ids": vs_ids}],
             )
-            return getattr(resp, "output_text", "").strip() or _collect_output_chunks(resp)
+            breaker("file_search").record_success()
+            return text
         except Exception as e_a:
             print("OLD WAY: ", e_a)
+            if isinstance(e_a, DeadlineExceeded):
+                raise
+            if deadline is not None and deadline.remaining() < FILE_SEARCH_MIN_BUDGET_S:
+                # на второй заход с file_search времени нет — последний шанс без векторки
+                fallback("skip_legacy_retry", f"{deadline.remaining():.1f}s left")
+                return _create(input=input_messages)
             # Если сервер старый/иной — fallback на attachments к последнему user
             # Подготовим копию сообщений с attachments
             im2 = list(input_messages)
@@ -323,24 +427,33 @@ class ChatGPTAgent:
                     break
 
             try:
-                resp = client.responses.create(
-                    model=model,
+                text = _create(
                     input=im2,
                     tools=[{"type": "file_search"}],
                 )
-                return getattr(resp, "output_text", "").strip() or _collect_output_chunks(resp)
+                breaker("file_search").record_success()
+                return text
             except Exception as e_b:
                 # Оба пути не сработали — пробрасываем первую ошибку для дебага
+                breaker("file_search").record_failure()
                 raise e_a
 
 
-    def send_message(self, chat_id: str, user_message: str, tg_user_id: str | int | None = None) -> str:
+    @profiled("send_message")
+    def send_message(
+        self,
+        chat_id: str,
+        user_message: str,
+        tg_user_id: str | int | None = None,
+        deadline: Optional[Deadline] = None
+    ) -> str:
         """
         Отправка сообщения агенту в рамках чата:
          - Берёт system_prompt и response_format из настроек чата
          - Отправляет history + новое сообщение
          - Возвращает ответ ассистента (строкой)
          - История чата обновляется
+         - deadline (необязательно) — бюджет хода, см. deadline.py
         """
         if chat_id not in self.chats:
             raise ValueError(f"Чат {chat_id} не существует. Создайте чат через create_chat().")
@@ -356,8 +469,9 @@ class ChatGPTAgent:
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
 
-        # История — как есть (user/assistant)
-        messages.extend(history)
+        # История (user/assistant): расжимаем только окно, которое уходит в модель
+        window = history[-HISTORY_WINDOW:] if HISTORY_WINDOW > 0 else history
+        messages.extend(decode_turn(t) for t in window)
 
         user_msg = {"role": "user", "content": user_message}
         messages.append(user_msg)
@@ -370,16 +484,49 @@ class ChatGPTAgent:
             messages=messages,
             response_format=response_format,
             # vector_store_id=vs_id
-            vector_store_ids=vs_ids
+            vector_store_ids=vs_ids,
+            deadline=deadline
         )
 
         # Обновляем историю чата
-        history.append(user_msg)
-        history.append({"role": "assistant", "content": reply_content})
-        self._save_chats()
+        with self._lock:
+            history.append(self._make_turn("user", user_message))
+            history.append(self._make_turn("assistant", reply_content))
+            self._save_chats()
+            turns = len(history)
+        self.index.touch(chat_id, turns)
 
         return reply_content
 
+    def complete_once(self, system_prompt: str, user_message: str, response_format: Optional[dict] = None) -> str:
+        """
+        Разовый запрос вне чатов (история не читается и не пишется), только с общей векторкой.
+        Используется для заготовок (пул уроков).
+        """
+        messages: List[Dict[str, str]] = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": user_message})
+        vs_ids = [self.global_vector_store_id] if self.global_vector_store_id else []
+        return self._responses_api_call(
+            model=OPENAI_TEXT_MODEL,
+            messages=messages,
+            response_format=response_format,
+            vector_store_ids=vs_ids
+        )
+
+    def append_turn(self, chat_id: str, user_message: str, assistant_message: str):
+        """Дописывает в историю готовую пару реплик (ответ получен не из модели, а из пула)."""
+        if chat_id not in self.chats:
+            raise ValueError(f"Чат {chat_id} не существует. Создайте чат через create_chat().")
+        with self._lock:
+            history = self.chats[chat_id]["history"]
+            history.append(self._make_turn("user", user_message))
+            history.append(self._make_turn("assistant", assistant_message))
+            self._save_chats()
+            turns = len(history)
+        self.index.touch(chat_id, turns)
+
     # ===== Совместимость со старым методом =====
 
     def chat(self, chat_id: str, user_message: str, n_results: int = 3) -> str:
@@ -0,0 +1,276 @@
+# app/profiler.py
+"""
+Профилирование живого бота по команде администратора, без рестарта.
+
+  /prof 50      — профилировать следующие 50 сообщений
+  /prof 30s     — профилировать 30 секунд
+  /prof stop    — остановить досрочно и записать отчёт
+  /prof status  — идёт ли сессия, где последний отчёт
+
+Пока сессия активна:
+  * поток-сэмплер PROFILE_SAMPLE_HZ раз в секунду снимает стеки всех потоков
+    (sys._current_frames) — wall-clock, без простоя event loop и пулов;
+  * tracemalloc пишет аллокации (снимки в начале и в конце сессии);
+  * функции конвейера, помеченные @profiled("имя"), считают вызовы и время.
+
+Отчёт — в PROFILE_DIR/<время>/:
+  stacks.folded    — свёрнутые стеки для flamegraph.pl / speedscope
+  pipeline.txt     — по функциям конвейера: вызовы, время, доля сэмплов
+  allocations.txt  — топ аллокаций за сессию и удержанная память по функциям конвейера
+
+Сессия в любом случае закрывается через PROFILE_MAX_SEC.
+Вне сессии @profiled стоит одну проверку флага.
+"""
+import dis
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import PROFILE_DIR, PROFILE_SAMPLE_HZ, PROFILE_MAX_SEC
+
+
+TRACEMALLOC_FRAMES = 25
+TOP_ALLOCATIONS = 30
+
+# листья стеков, которые означают ожидание, а не работу
+IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Разметка функций конвейера
+# ─────────────────────────────────────────────────────────────────────────────
+_labels: Dict[object, str] = {}                         # code object → имя в отчёте
+_line_ranges: Dict[str, List[Tuple[str, int, int]]] = defaultdict(list)  # имя → (файл, строки)
+
+
+def _code_lines(code) -> Tuple[int, int]:
+    lines = [ln for _, ln in dis.findlinestarts(code) if ln is not None]
+    return (min(lines), max(lines)) if lines else (code.co_firstlineno, code.co_firstlineno)
+
+
+def profiled(label: str):
+    """Помечает функцию конвейера: несколько функций могут делить одно имя (например, «audio_assembly»)."""
+    def decorator(fn):
+        code = fn.__code__
+        _labels[code] = label
+        first, last = _code_lines(code)
+        _line_ranges[label].append((code.co_filename, first, last))
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            session = _session
+            if session is None:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                session.observe(label, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Сессия
+# ─────────────────────────────────────────────────────────────────────────────
+class ProfileSession:
+    def __init__(self, messages: int = 0, seconds: float = 0.0, hz: float = PROFILE_SAMPLE_HZ):
+        self.messages_left = messages
+        self.seconds = seconds
+        self.max_seconds = min(seconds, PROFILE_MAX_SEC) if seconds else PROFILE_MAX_SEC
+        self.interval = 1.0 / hz
+        self.started_at = time.monotonic()
+        self.stacks: Counter = Counter()
+        self.pipeline_samples: Counter = Counter()
+        self.samples = 0
+        self.calls: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._own_tracemalloc = not tracemalloc.is_tracing()
+        if self._own_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._snap_start = tracemalloc.take_snapshot()
+        self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._thread.start()
+
+    def describe(self) -> str:
+        limit = f"{self.messages_left} msg left" if self.messages_left else f"{self.seconds:.0f}s"
+        return f"running {time.monotonic() - self.started_at:.0f}s, {limit}, {self.samples} samples"
+
+    def observe(self, label: str, dur: float):
+        with self._lock:
+            self.calls[label].append(dur)
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            if time.monotonic() - self.started_at >= self.max_seconds:
+                # по таймеру завершаем из отдельного потока: stop() ждёт этот
+                threading.Thread(target=stop, name="profiler-stop", daemon=True).start()
+                return
+            frames = sys._current_frames()
+            if len(frames) != len(names):
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident != me:
+                    self._record_stack(names.get(ident, str(ident)), frame)
+
+    def _record_stack(self, thread_name: str, frame):
+        leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+        if leaf in IDLE_LEAVES:
+            return
+        parts: List[str] = []
+        labels = set()
+        f = frame
+        while f is not None:
+            code = f.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            label = _labels.get(code)
+            if label:
+                labels.add(label)
+            f = f.f_back
+        parts.append(thread_name)
+        with self._lock:
+            self.samples += 1
+            self.stacks[";".join(reversed(parts))] += 1
+            for label in labels:
+                self.pipeline_samples[label] += 1
+
+    def note_message(self) -> bool:
+        """Сообщение обработано; True — лимит сообщений исчерпан."""
+        if not self.messages_left:
+            return False
+        with self._lock:
+            self.messages_left -= 1
+            return self.messages_left <= 0
+
+    def finish(self, base: Path = PROFILE_DIR) -> Path:
+        self._stop.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+        snap_end = tracemalloc.take_snapshot()
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+
+        out = base / datetime.now().strftime("%Y%m%d-%H%M%S")
+        out.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            (out / "stacks.folded").write_text(
+                "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common()), encoding="utf-8"
+            )
+            (out / "pipeline.txt").write_text(self._pipeline_report(), encoding="utf-8")
+        (out / "allocations.txt").write_text(self._allocation_report(snap_end), encoding="utf-8")
+        return out
+
+    def _pipeline_report(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        lines = [
+            f"session {elapsed:.1f}s, {self.samples} samples at {1 / self.interval:.0f} Hz",
+            "",
+            f"{'function':<24} {'calls':>6} {'total_s':>9} {'mean_ms':>9} {'max_ms':>9} {'samples%':>9}",
+        ]
+        for label in sorted(set(_line_ranges) | set(self.calls)):
+            durs = self.calls.get(label, [])
+            total = sum(durs)
+            mean_ms = total / len(durs) * 1000 if durs else 0.0
+            max_ms = max(durs) * 1000 if durs else 0.0
+            share = self.pipeline_samples[label] / self.samples * 100 if self.samples else 0.0
+            lines.append(f"{label:<24} {len(durs):>6} {total:>9.3f} {mean_ms:>9.1f} {max_ms:>9.1f} {share:>8.1f}%")
+        return "\n".join(lines) + "\n"
+
+    def _allocation_report(self, snap_end) -> str:
+        lines = [f"top {TOP_ALLOCATIONS} allocation sites by growth during the session:"]
+        for stat in snap_end.compare_to(self._snap_start, "lineno")[:TOP_ALLOCATIONS]:
+            lines.append(f"  {stat}")
+
+        retained: Counter = Counter()
+        for stat in snap_end.statistics("traceback"):
+            for label in _labels_in_traceback(stat.traceback):
+                retained[label] += stat.size
+        lines += ["", "retained at session end, by pipeline function (inclusive):"]
+        for label in sorted(_line_ranges):
+            lines.append(f"  {label:<24} {retained[label] / 1024:>10.1f} KiB")
+        return "\n".join(lines) + "\n"
+
+
+def _labels_in_traceback(tb) -> set:
+    found = set()
+    for frame in tb:
+        for label, ranges in _line_ranges.items():
+            if any(frame.filename == fn and first <= frame.lineno <= last for fn, first, last in ranges):
+                found.add(label)
+    return found
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Управление (одна сессия на процесс)
+# ─────────────────────────────────────────────────────────────────────────────
+_session: Optional[ProfileSession] = None
+_control_lock = threading.Lock()
+last_report: Optional[Path] = None
+
+
+def start(messages: int = 0, seconds: float = 0.0) -> bool:
+    global _session
+    with _control_lock:
+        if _session is not None:
+            return False
+        _session = ProfileSession(messages=messages, seconds=seconds)
+    limit = f"{messages} messages" if messages else f"{seconds:.0f}s"
+    print(f"[prof] started for {limit}")
+    return True
+
+
+def stop() -> Optional[Path]:
+    global _session, last_report
+    with _control_lock:
+        session, _session = _session, None
+    if session is None:
+        return None
+    last_report = session.finish()
+    print(f"[prof] report written to {last_report}")
+    return last_report
+
+
+def status() -> str:
+    session = _session
+    if session is not None:
+        return session.describe()
+    return f"idle, last report: {last_report}" if last_report else "idle"
+
+
+def active() -> bool:
+    return _session is not None
+
+
+def note_message() -> Optional[Path]:
+    """Вызывается после каждого хода; закрывает сессию по лимиту сообщений."""
+    session = _session
+    if session is not None and session.note_message():
+        return stop()
+    return None
+
+
+def parse_command(args: List[str]) -> Tuple[str, int, float]:
+    """/prof [N | Ns | stop | status] → (действие, сообщений, секунд); N и секунды — больше нуля."""
+    arg = args[0].strip().lower() if args else "status"
+    if arg in ("stop", "status"):
+        return arg, 0, 0.0
+    if arg.endswith("s") and arg[:-1].isdigit() and int(arg[:-1]) > 0:
+        return "start", 0, float(arg[:-1])
+    if arg.isdigit() and int(arg) > 0:
+        return "start", int(arg), 0.0
+    raise ValueError(arg)
@@ -0,0 +1,243 @@
+# app/replay.py
+"""
+Детерминированный прогон записанного трафика (traffic_trace.py) через on_message.
+
+Ответы модели берутся из трейса (с записанной задержкой, делённой на --speed),
+TTS отвечает тишиной нужного формата с записанной задержкой, Telegram — заглушка.
+Всё остальное — разбор JSON, склейка аудио, нарезка сообщений, история — работает по-настоящему,
+в отдельной временной папке (реальные chats.json / students не трогаются).
+Ходы идут по одному, как у PTB по умолчанию: следующий ждёт и своего времени в трейсе,
+и конца предыдущего — иначе задержки этапов несравнимы с продом.
+
+  python replay.py run trace.jsonl.gz --speed 10 --out build_a.json
+  python replay.py diff build_a.json build_b.json
+"""
+import argparse
+import asyncio
+import contextvars
+import gzip
+import json
+import os
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+
+@dataclass
+class RecordedTurn:
+    turn: str
+    t: float
+    user: str
+    text: str
+    responses: List[dict] = field(default_factory=list)
+
+
+def load_trace(path: Path) -> Tuple[List[RecordedTurn], Dict[Tuple[str, str], float]]:
+    """Ходы с записанными ответами модели + длительности TTS по (голос, текст)."""
+    turns: Dict[str, RecordedTurn] = {}
+    tts: Dict[Tuple[str, str], float] = {}
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            try:
+                ev = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # хвост недописанного файла
+            kind, tid = ev.get("ev"), ev.get("turn", "")
+            if kind == "update":
+                turns[tid] = RecordedTurn(tid, ev["t"], ev["user"], ev["text"])
+            elif kind == "model_response" and ev.get("ok") and tid in turns:
+                turns[tid].responses.append({"text": ev["text"], "dur": ev["dur"]})
+            elif kind == "tts":
+                tts[(ev["voice"], ev["text"])] = ev["dur"]
+    ordered = sorted(turns.values(), key=lambda x: x.t)
+    return ordered, tts
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Заглушки Telegram
+# ─────────────────────────────────────────────────────────────────────────────
+class FakeBot:
+    id = 0
+
+    def __init__(self):
+        self.sent: List[Tuple[str, float]] = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.sent.append(("text", time.monotonic()))
+
+    async def send_audio(self, chat_id, audio, title=None):
+        self.sent.append(("audio", time.monotonic()))
+
+    async def send_voice(self, chat_id, voice, caption=None):
+        self.sent.append(("voice", time.monotonic()))
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+    async def send_action(self, action):
+        pass
+
+
+def fake_update(bot: FakeBot, user: str, text: str):
+    chat = FakeChat(user)
+    return SimpleNamespace(
+        message=SimpleNamespace(text=text, chat=chat),
+        effective_user=SimpleNamespace(id=user),
+        effective_chat=chat,
+        get_bot=lambda: bot,
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Подготовка пайплайна
+# ─────────────────────────────────────────────────────────────────────────────
+_replay_turn: contextvars.ContextVar[RecordedTurn] = contextvars.ContextVar("replay_turn")
+
+
+def _silence(fmt: str, workdir: Path) -> bytes:
+    import tts
+    pcm = b"\x00" * (tts.PCM_SAMPLE_RATE * tts.PCM_SAMPLE_WIDTH // 2)  # 0.5 с
+    if fmt == "pcm":
+        return pcm
+    out = workdir / f"silence.{'ogg' if fmt == 'opus' else 'mp3'}"
+    if not out.exists():
+        codec = ["-c:a", "libopus"] if fmt == "opus" else ["-c:a", "libmp3lame"]
+        tts._run_ffmpeg(["-f", "s16le", "-ar", str(tts.PCM_SAMPLE_RATE), "-ac", "1", "-i", "pipe:0",
+                         *codec, str(out)], stdin=pcm)
+    return out.read_bytes()
+
+
+def prepare_pipeline(workdir: Path, tts_durations: Dict[Tuple[str, str], float], speed: float,
+                     recorded_latency: bool, rate_limit: bool):
+    import config
+    # до импорта traffic_trace: иначе он откроет боевой трейс и допишет в него session
+    config.TRACE_CAPTURE_PATH = ""
+    import openai_client  # читает ./.env — до смены папки
+    # main при импорте открывает ./chats.json (миграция, delete_chat, индекс рядом) — пусть во временной
+    os.chdir(workdir)
+    import main
+    import tts
+    from lesson_pool import LessonPool
+    from sender import TelegramSender
+
+    main.STUDENTS_DIR = str(workdir / "students")
+    main.lesson_pool = LessonPool(workdir / "lesson_pool", size=0)
+    if not rate_limit:
+        main.sender = TelegramSender(global_rate=0, chat_rate=0)
+
+    def _sleep(dur: float):
+        if recorded_latency and dur:
+            time.sleep(dur / speed)
+
+    def fake_responses_api_call(self, model, messages, response_format=None, vector_store_ids=None, deadline=None):
+        turn = _replay_turn.get()
+        resp = turn.responses.pop(0) if turn.responses else {"text": "", "dur": 0.0}
+        _sleep(resp["dur"])
+        return resp["text"]
+
+    silence_cache: Dict[str, bytes] = {}
+
+    def fake_speech_bytes(voice, text, fmt, timeout=None):
+        _sleep(tts_durations.get((voice, text), 0.0))
+        if fmt not in silence_cache:
+            silence_cache[fmt] = _silence(fmt, workdir)
+        return silence_cache[fmt]
+
+    openai_client.ChatGPTAgent._responses_api_call = fake_responses_api_call
+    openai_client.ChatGPTAgent._get_or_create_user_vs = lambda self, uid: "vs_replay"
+    tts._speech_bytes = fake_speech_bytes
+    return main
+
+
+async def replay(trace_path: Path, speed: float, recorded_latency: bool, rate_limit: bool) -> dict:
+    turns, tts_durations = load_trace(trace_path)
+    runnable = [t for t in turns if t.responses]
+    workdir = Path(tempfile.mkdtemp(prefix="jp_replay_"))
+    main = prepare_pipeline(workdir, tts_durations, speed, recorded_latency, rate_limit)
+    import metrics
+
+    bot = FakeBot()
+    turn_totals: List[float] = []
+
+    t_first = runnable[0].t if runnable else 0.0
+    started = time.monotonic()
+    for turn in runnable:
+        delay = (turn.t - t_first) / speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        _replay_turn.set(turn)
+        t0 = time.perf_counter()
+        await main.on_message(fake_update(bot, turn.user, turn.text), None)
+        turn_totals.append(time.perf_counter() - t0)
+
+    snap = metrics.snapshot()
+    stages = {k: v for k, v in snap["timings"].items() if k.startswith("stage.") or k == "ttfm_s"}
+    return {
+        "build": _git_describe(),
+        "trace": str(trace_path),
+        "speed": speed,
+        "turns": len(runnable),
+        "skipped_turns": len(turns) - len(runnable),
+        "messages_sent": len(bot.sent),
+        "stages": stages,
+        "fallbacks": {k: v for k, v in snap["counters"].items() if k.startswith("fallback.")},
+    }
+
+
+def _git_describe() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).resolve().parent).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def diff_reports(a: dict, b: dict):
+    print(f"A: {a['build']} ({a['turns']} turns)   B: {b['build']} ({b['turns']} turns)")
+    print(f"{'stage':<16} {'A p50':>8} {'B p50':>8} {'Δ p50':>8} {'A p95':>8} {'B p95':>8} {'Δ p95':>8}")
+    for name in sorted(set(a["stages"]) | set(b["stages"])):
+        sa, sb = a["stages"].get(name, {}), b["stages"].get(name, {})
+        row = [sa.get("p50", 0.0), sb.get("p50", 0.0), sa.get("p95", 0.0), sb.get("p95", 0.0)]
+        d50 = _pct(row[0], row[1])
+        d95 = _pct(row[2], row[3])
+        print(f"{name:<16} {row[0]:>8.3f} {row[1]:>8.3f} {d50:>8} {row[2]:>8.3f} {row[3]:>8.3f} {d95:>8}")
+
+
+def _pct(a: float, b: float) -> str:
+    if not a:
+        return "n/a"
+    return f"{(b - a) / a * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay записанного трафика")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_run = sub.add_parser("run")
+    p_run.add_argument("trace", type=Path)
+    p_run.add_argument("--speed", type=float, default=1.0, help="ускорение: 10 — в 10 раз быстрее оригинала")
+    p_run.add_argument("--no-latency", action="store_true", help="не воспроизводить задержки модели и TTS")
+    p_run.add_argument("--no-rate-limit", action="store_true", help="выключить лимиты исходящих сообщений")
+    p_run.add_argument("--out", type=Path, default=Path("replay_report.json"))
+    p_diff = sub.add_parser("diff")
+    p_diff.add_argument("a", type=Path)
+    p_diff.add_argument("b", type=Path)
+    args = parser.parse_args()
+
+    if args.cmd == "run":
+        args.trace, args.out = args.trace.resolve(), args.out.resolve()  # прогон меняет рабочую папку
+        report = asyncio.run(replay(args.trace, args.speed, not args.no_latency, not args.no_rate_limit))
+        args.out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        diff_reports(json.loads(args.a.read_text(encoding="utf-8")), json.loads(args.b.read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Исходящая доставка в Telegram.
+
+- режет текст ДО экранирования: по абзацам → строкам → предложениям,
+  так что escape-последовательность MarkdownV2 никогда не рвётся между сообщениями;
+- склеивает мелкие подряд идущие сообщения одного чата в одно;
+- лимиты: глобальный (на бота) и на чат + обработка RetryAfter (flood wait);
+- если Telegram не смог разобрать MarkdownV2 — досылает кусок обычным текстом.
+"""
+import asyncio
+import re
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, NetworkError
+from telegram.helpers import escape_markdown
+
+from config import TG_GLOBAL_RATE, TG_CHAT_RATE, TG_SEND_RETRIES
+
+
+MAX_TG_TEXT = 4000  # чуть меньше реального лимита (4096), считается ПОСЛЕ экранирования
+
+RE_PARAGRAPH_SPLIT = re.compile(r"\n{2,}")
+# конец предложения вместе с пробелами после него: японские 。！？ — всегда,
+# точка и !? — только перед пробелом (не «3.5», не «v1.2»)
+RE_SENTENCE_END = re.compile(r"[。！？]\s*|[!?．.]\s+")
+FENCE = "```"
+
+
+def escaped_len(text: str) -> int:
+    return len(escape_markdown(text, version=2))
+
+
+def _paragraph_units(text: str) -> List[str]:
+    """
+    Абзацы; блок ``` ... ``` (даже с пустыми строками внутри) остаётся одной единицей.
+    """
+    units: List[str] = []
+    buf: List[str] = []
+    in_fence = False
+    for para in RE_PARAGRAPH_SPLIT.split(text):
+        if in_fence:
+            buf.append(para)
+        else:
+            buf = [para]
+        if para.count(FENCE) % 2 == 1:
+            in_fence = not in_fence
+        if not in_fence:
+            units.append("\n\n".join(buf))
+            buf = []
+    if buf:
+        units.append("\n\n".join(buf))
+    return [u for u in units if u.strip()]
+
+
+def _hard_cut(text: str, limit: int) -> List[str]:
+    """Последний рубеж: режем посимвольно, считая длину с учётом экранирования."""
+    out: List[str] = []
+    cur: List[str] = []
+    cur_len = 0
+    for ch in text:
+        ch_len = escaped_len(ch)
+        if cur and cur_len + ch_len > limit:
+            out.append("".join(cur))
+            cur, cur_len = [], 0
+        cur.append(ch)
+        cur_len += ch_len
+    if cur:
+        out.append("".join(cur))
+    return out
+
+
+def _pack(parts: List[str], sep: str, limit: int, finer) -> List[str]:
+    """
+    Жадно собирает части в куски с escaped-длиной <= limit.
+    Слишком длинная часть дробится функцией finer.
+    """
+    out: List[str] = []
+    cur = ""
+    for part in parts:
+        if escaped_len(part) > limit:
+            if cur:
+                out.append(cur)
+                cur = ""
+            out.extend(finer(part, limit))
+            continue
+        candidate = f"{cur}{sep}{part}" if cur else part
+        if escaped_len(candidate) <= limit:
+            cur = candidate
+        else:
+            out.append(cur)
+            cur = part
+    if cur:
+        out.append(cur)
+    return out
+
+
+def _split_sentences(text: str, limit: int) -> List[str]:
+    # каждое предложение несёт свой настоящий разделитель — склейка через "" не меняет текст
+    parts: List[str] = []
+    pos = 0
+    for m in RE_SENTENCE_END.finditer(text):
+        parts.append(text[pos:m.end()])
+        pos = m.end()
+    if pos < len(text):
+        parts.append(text[pos:])
+    return _pack(parts, "", limit, _hard_cut)
+
+
+def _split_lines(text: str, limit: int) -> List[str]:
+    return _pack(text.split("\n"), "\n", limit, _split_sentences)
+
+
+def split_text(text: str, limit: int = MAX_TG_TEXT) -> List[str]:
+    """
+    Делит сырой (неэкранированный) текст на куски, каждый из которых
+    после escape_markdown(version=2) укладывается в limit.
+    """
+    text = (text or "").strip()
+    if not text:
+        return []
+    return _pack(_paragraph_units(text), "\n\n", limit, _split_lines)
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    if isinstance(ra, timedelta):
+        return ra.total_seconds()
+    return float(ra)
+
+
+class _Throttle:
+    """Минимальный интервал между отправками (простое расписание «не раньше чем»)."""
+
+    def __init__(self, per_sec: float):
+        self.interval = 1.0 / per_sec if per_sec > 0 else 0.0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+                now = time.monotonic()
+            self.next_at = max(now, self.next_at) + self.interval
+
+    def pause(self, seconds: float):
+        self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+
+class TelegramSender:
+    def __init__(
+        self,
+        global_rate: float = TG_GLOBAL_RATE,
+        chat_rate: float = TG_CHAT_RATE,
+        retries: int = TG_SEND_RETRIES,
+        limit: int = MAX_TG_TEXT,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.retries = retries
+        self.limit = limit
+        self._global: Dict[int, _Throttle] = {}
+        self._chats: Dict[Tuple[int, int], _Throttle] = {}
+        self._outbox: Dict[Tuple[int, int], List[str]] = {}
+        self._sent: Dict[Tuple[int, int], int] = {}
+
+    # ----- лимиты -----
+
+    def _throttles(self, bot, chat_id: int) -> Tuple[_Throttle, _Throttle]:
+        g = self._global.setdefault(bot.id, _Throttle(self.global_rate))
+        c = self._chats.setdefault((bot.id, chat_id), _Throttle(self.chat_rate))
+        return g, c
+
+    async def _call(self, bot, chat_id: int, fn):
+        """
+        Выполняет отправку с учётом лимитов; на RetryAfter ждёт и повторяет.
+        fn — корутинная фабрика без аргументов (файлы надо открывать заново на каждую попытку).
+        """
+        g, c = self._throttles(bot, chat_id)
+        attempt = 0
+        while True:
+            await g.wait()
+            await c.wait()
+            try:
+                result = await fn()
+                self._sent[(bot.id, chat_id)] = self._sent.get((bot.id, chat_id), 0) + 1
+                return result
+            except RetryAfter as e:
+                wait_s = _retry_after_seconds(e)
+                print(f"[sender] flood wait {wait_s:.1f}s for chat {chat_id}")
+                c.pause(wait_s)
+                if attempt >= self.retries:
+                    raise
+            except NetworkError as e:
+                # BadRequest тоже наследник NetworkError, но повторять его бессмысленно
+                if isinstance(e, BadRequest) or attempt >= self.retries:
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 10))
+            attempt += 1
+
+    def sent_count(self, bot, chat_id: int) -> int:
+        """Сколько сообщений ушло в чат (чтобы понять, видел ли ученик часть ответа)."""
+        return self._sent.get((bot.id, chat_id), 0)
+
+    # ----- текст -----
+
+    async def send_text(self, bot, chat_id: int, text: str):
+        for piece in split_text(text, self.limit):
+            await self._send_piece(bot, chat_id, piece)
+
+    async def _send_piece(self, bot, chat_id: int, piece: str):
+        safe = escape_markdown(piece, version=2)
+        try:
+            await self._call(bot, chat_id, lambda: bot.send_message(
+                chat_id=chat_id, text=safe, parse_mode=ParseMode.MARKDOWN_V2
+            ))
+        except BadRequest as e:
+            # MarkdownV2 не разобрался — не теряем сообщение, шлём как есть
+            print(f"[sender] markdown rejected ({e}), resending as plain text")
+            await self._call(bot, chat_id, lambda: bot.send_message(chat_id=chat_id, text=piece))
+
+    async def send_plain(self, bot, chat_id: int, text: str):
+        """Без разметки (ошибки, служебные уведомления)."""
+        for piece in split_text(text, self.limit):
+            await self._call(bot, chat_id, lambda p=piece: bot.send_message(chat_id=chat_id, text=p))
+
+    def queue_text(self, bot, chat_id: int, text: str):
+        """Откладывает текст до flush(): мелкие соседние сообщения будут склеены."""
+        if text and text.strip():
+            self._outbox.setdefault((bot.id, chat_id), []).append(text.strip())
+
+    async def flush(self, bot, chat_id: int):
+        pending = self._outbox.pop((bot.id, chat_id), [])
+        if not pending:
+            return
+        for msg in self.coalesce(pending):
+            await self.send_text(bot, chat_id, msg)
+
+    def coalesce(self, texts: List[str]) -> List[str]:
+        """Склеивает подряд идущие тексты, пока результат помещается в одно сообщение."""
+        out: List[str] = []
+        for t in texts:
+            if out and escaped_len(out[-1]) + escaped_len(t) + 2 <= self.limit:
+                out[-1] = f"{out[-1]}\n\n{t}"
+            else:
+                out.append(t)
+        return out
+
+    # ----- медиа -----
+
+    async def send_audio(self, bot, chat_id: int, path: Path, title: Optional[str] = None):
+        async def _do():
+            with open(path, "rb") as fh:
+                return await bot.send_audio(chat_id=chat_id, audio=fh, title=title)
+        return await self._call(bot, chat_id, _do)
+
+    async def send_voice(self, bot, chat_id: int, path: Path, caption: Optional[str] = None):
+        """OGG/Opus как голосовое сообщение: на мобильных играет сразу, без скачивания файла целиком."""
+        async def _do():
+            with open(path, "rb") as fh:
+                return await bot.send_voice(chat_id=chat_id, voice=fh, caption=caption)
+        return await self._call(bot, chat_id, _do)
+
+    async def send_dialogue_audio(self, bot, chat_id: int, path: Path, title: str = "Аудирование"):
+        """Выбирает способ отправки по формату файла из tts.synth_dialogue()."""
+        if Path(path).suffix == ".ogg":
+            return await self.send_voice(bot, chat_id, path, caption=title)
+        return await self.send_audio(bot, chat_id, path, title=title)
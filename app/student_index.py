@@ -0,0 +1,323 @@
+# app/student_index.py
+"""
+Вторичный индекс по чатам и ученикам (SQLite) для админских запросов.
+
+Источник правды не меняется: chats.json и students/<id>/*. Индекс лишь дублирует
+то, по чему нужно фильтровать и сортировать, и поддерживается на каждой записи:
+  ChatGPTAgent — создание/удаление чата, новые ходы (last_activity, turns), vector store;
+  main.save_score — score и level.
+Если индекс пуст или разошёлся с chats.json по числу чатов — перестраивается целиком.
+
+Файл индекса лежит рядом с chats.json: chats.json → chats.index.sqlite.
+
+CLI (из app/):
+  python student_index.py query --chats ../chats.json --level N4 --min-score 300 --inactive-days 7
+  python student_index.py query --chats ../chats.json --text tanaka --order score --page 2
+  python student_index.py rebuild --chats ../chats.json
+  python student_index.py bench --n 100000
+"""
+import argparse
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+
+PAGE_SIZE = 20
+ORDER_COLUMNS = {"last_activity", "score", "level", "turns", "chat_id"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id         TEXT PRIMARY KEY,
+    title           TEXT NOT NULL DEFAULT '',
+    description     TEXT NOT NULL DEFAULT '',
+    level           TEXT,
+    score           INTEGER,
+    last_activity   TEXT,
+    turns           INTEGER NOT NULL DEFAULT 0,
+    vector_store_id TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_chats_level_score ON chats(level, score, chat_id);
+CREATE INDEX IF NOT EXISTS ix_chats_score ON chats(score, chat_id);
+CREATE INDEX IF NOT EXISTS ix_chats_activity ON chats(last_activity, chat_id);
+
+-- поиск подстроки: триграммный FTS5 поверх той же таблицы, синхронизируется триггерами
+CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(
+    chat_id, title, description, content='chats', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS chats_ai AFTER INSERT ON chats BEGIN
+    INSERT INTO chats_fts(rowid, chat_id, title, description)
+    VALUES (new.rowid, new.chat_id, new.title, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS chats_ad AFTER DELETE ON chats BEGIN
+    INSERT INTO chats_fts(chats_fts, rowid, chat_id, title, description)
+    VALUES ('delete', old.rowid, old.chat_id, old.title, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS chats_au AFTER UPDATE OF chat_id, title, description ON chats BEGIN
+    INSERT INTO chats_fts(chats_fts, rowid, chat_id, title, description)
+    VALUES ('delete', old.rowid, old.chat_id, old.title, old.description);
+    INSERT INTO chats_fts(rowid, chat_id, title, description)
+    VALUES (new.rowid, new.chat_id, new.title, new.description);
+END;
+"""
+TRIGRAM = 3  # запросы короче триграммы FTS не находит — для них линейный поиск
+_COLUMNS = "chat_id, title, description, level, score, last_activity, turns, vector_store_id"
+
+
+def index_path_for(chats_path: Union[str, Path]) -> Path:
+    p = Path(chats_path)
+    return p.with_name(f"{p.stem}.index.sqlite")
+
+
+def utc_now_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+class StudentIndex:
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # соединение общее для event loop и потоков to_thread/jobs — сериализуем замком
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        # lower() в SQLite складывает только ASCII («Та» не найдёт «Танака») — берём str.lower
+        self._db.create_function("py_lower", 1, _py_lower, deterministic=True)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # ----- запись -----
+
+    def upsert(self, chat_id: str, **fields):
+        """Обновляет переданные поля (остальные не трогает), создаёт строку при необходимости."""
+        cols = ["chat_id", *fields]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in fields) or "chat_id = chat_id"
+        sql = (
+            f"INSERT INTO chats ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT(chat_id) DO UPDATE SET {updates}"
+        )
+        with self._lock:
+            self._db.execute(sql, [str(chat_id), *fields.values()])
+            self._db.commit()
+
+    def touch(self, chat_id: str, turns: int):
+        self.upsert(chat_id, last_activity=utc_now_iso(), turns=turns)
+
+    def delete(self, chat_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM chats WHERE chat_id = ?", (str(chat_id),))
+            self._db.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    def rebuild(self, chats: Dict[str, Dict], users: Dict[str, Dict], students_dir: Path):
+        """Полная перестройка из chats.json, метаданных пользователей и students/<id>/score.json."""
+        rows = []
+        for cid, cdata in chats.items():
+            if not isinstance(cdata, dict):
+                continue
+            score, level = _read_score(students_dir / cid)
+            rows.append((
+                cid,
+                cdata.get("title", ""),
+                cdata.get("description", ""),
+                level,
+                score,
+                _last_activity(students_dir / cid),
+                len(cdata.get("history", [])),
+                (users.get(cid) or {}).get("vector_store_id"),
+            ))
+        with self._lock:
+            self._db.execute("DELETE FROM chats")
+            self._db.executemany(f"INSERT INTO chats ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+        print(f"[index] rebuilt {self.path.name}: {len(rows)} chats")
+
+    # ----- чтение -----
+
+    def query(
+        self,
+        level: Optional[str] = None,
+        min_score: Optional[int] = None,
+        max_score: Optional[int] = None,
+        active_since: Optional[str] = None,
+        inactive_since: Optional[str] = None,
+        text: Optional[str] = None,
+        order: str = "last_activity",
+        desc: bool = True,
+        limit: int = PAGE_SIZE,
+        offset: int = 0,
+    ) -> List[Dict]:
+        """
+        Фильтры комбинируются через AND. active_since / inactive_since — ISO-время UTC:
+        была активность после / не было активности после. text — подстрока в id, title, description.
+        """
+        if order not in ORDER_COLUMNS:
+            raise ValueError(f"order: одно из {sorted(ORDER_COLUMNS)}")
+        where, args = self._where(level, min_score, max_score, active_since, inactive_since, text)
+        # порядок совпадает с индексами (колонка, chat_id): сортировки нет, страница читается с индекса;
+        # NULL (нет данных) в SQLite меньше любых значений — при DESC они в конце
+        direction = "DESC" if desc else "ASC"
+        tiebreak = f", chat_id {direction}" if order != "chat_id" else ""
+        sql = f"SELECT {_COLUMNS} FROM chats{where} ORDER BY {order} {direction}{tiebreak} LIMIT ? OFFSET ?"
+        with self._lock:
+            return [dict(r) for r in self._db.execute(sql, [*args, limit, offset])]
+
+    def total(self, **filters) -> int:
+        where, args = self._where(**filters)
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM chats{where}", args).fetchone()[0]
+
+    @staticmethod
+    def _where(level=None, min_score=None, max_score=None, active_since=None, inactive_since=None, text=None):
+        conds, args = [], []
+        if level:
+            conds.append("level = ?")
+            args.append(level)
+        if min_score is not None:
+            conds.append("score >= ?")
+            args.append(min_score)
+        if max_score is not None:
+            conds.append("score <= ?")
+            args.append(max_score)
+        if active_since:
+            conds.append("last_activity >= ?")
+            args.append(active_since)
+        if inactive_since:
+            conds.append("(last_activity IS NULL OR last_activity < ?)")
+            args.append(inactive_since)
+        if text:
+            if len(text) >= TRIGRAM:
+                conds.append("rowid IN (SELECT rowid FROM chats_fts WHERE chats_fts MATCH ?)")
+                args.append('"' + text.replace('"', '""') + '"')
+            else:
+                conds.append("(instr(py_lower(chat_id), ?) OR instr(py_lower(title), ?) OR instr(py_lower(description), ?))")
+                args += [text.lower()] * 3
+        return (" WHERE " + " AND ".join(conds) if conds else ""), args
+
+
+def _py_lower(value) -> Optional[str]:
+    return value.lower() if isinstance(value, str) else value
+
+
+def _read_score(student: Path):
+    p = student / "score.json"
+    if not p.exists():
+        return None, None
+    try:
+        data = json.loads(p.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return None, None
+    return data.get("score"), data.get("level")
+
+
+def _last_activity(student: Path) -> Optional[str]:
+    """Самый свежий файл ученика — лучшее, что есть без отдельной отметки времени."""
+    if not student.is_dir():
+        return None
+    mtimes = [f.stat().st_mtime for f in student.iterdir() if f.is_file()]
+    if not mtimes:
+        return None
+    return datetime.fromtimestamp(max(mtimes), timezone.utc).replace(microsecond=0).isoformat()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# CLI
+# ─────────────────────────────────────────────────────────────────────────────
+def _print_rows(rows: Iterable[Dict]):
+    print(f"{'chat_id':<14} {'level':<5} {'score':>5} {'turns':>5}  {'last_activity':<25} title")
+    for r in rows:
+        print(f"{r['chat_id']:<14} {r['level'] or '-':<5} {r['score'] if r['score'] is not None else '-':>5} "
+              f"{r['turns']:>5}  {r['last_activity'] or '-':<25} {r['title']}")
+
+
+def _bench(n: int):
+    import random
+    tmp = Path(tempfile.mkdtemp(prefix="jp_index_")) / "bench.index.sqlite"
+    idx = StudentIndex(tmp)
+    now = datetime.now(timezone.utc)
+    rows = [(
+        str(100000000 + i), f"user:{100000000 + i}", "", random.choice(["N5", "N4", "N3", "N2", "N1"]),
+        random.randint(0, 1000), (now - timedelta(minutes=random.randint(0, 60 * 24 * 90))).replace(microsecond=0).isoformat(),
+        random.randint(0, 400), f"vs_{i}",
+    ) for i in range(n)]
+    with idx._lock:
+        idx._db.executemany(f"INSERT INTO chats ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        idx._db.commit()
+    week_ago = (now - timedelta(days=7)).isoformat()
+    cases = {
+        "level=N4 score>=500 by score": dict(level="N4", min_score=500, order="score"),
+        "inactive 7d by activity": dict(inactive_since=week_ago, order="last_activity", desc=False),
+        "active 7d, page 50": dict(active_since=week_ago, offset=50 * PAGE_SIZE),
+        "text search": dict(text="12345"),
+        "top score": dict(order="score"),
+    }
+    print(f"{n} chats in {tmp}")
+    for name, kw in cases.items():
+        t0 = time.perf_counter()
+        idx.query(**kw)
+        print(f"  {name:<32} {(time.perf_counter() - t0) * 1000:>7.2f} ms")
+    idx.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индекс чатов и учеников")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_q = sub.add_parser("query")
+    p_q.add_argument("--chats", type=Path, default=Path("./chats.json"))
+    p_q.add_argument("--level")
+    p_q.add_argument("--min-score", type=int)
+    p_q.add_argument("--max-score", type=int)
+    p_q.add_argument("--active-days", type=float, help="была активность за последние N дней")
+    p_q.add_argument("--inactive-days", type=float, help="не было активности N дней")
+    p_q.add_argument("--text")
+    p_q.add_argument("--order", default="last_activity", choices=sorted(ORDER_COLUMNS))
+    p_q.add_argument("--asc", action="store_true")
+    p_q.add_argument("--page", type=int, default=1)
+    p_q.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    p_r = sub.add_parser("rebuild")
+    p_r.add_argument("--chats", type=Path, default=Path("./chats.json"))
+    p_b = sub.add_parser("bench")
+    p_b.add_argument("--n", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.cmd == "bench":
+        _bench(args.n)
+        return
+    if args.cmd == "rebuild":
+        # для перестройки нужны данные агента (chats, users, students) — берём их через него
+        from openai_client import ChatGPTAgent
+        ChatGPTAgent(chats_path=str(args.chats)).rebuild_index()
+        return
+
+    now = datetime.now(timezone.utc)
+    ago = lambda days: (now - timedelta(days=days)).replace(microsecond=0).isoformat() if days else None
+    filters = dict(
+        level=args.level, min_score=args.min_score, max_score=args.max_score,
+        active_since=ago(args.active_days), inactive_since=ago(args.inactive_days), text=args.text,
+    )
+    idx = StudentIndex(index_path_for(args.chats))
+    t0 = time.perf_counter()
+    rows = idx.query(**filters, order=args.order, desc=not args.asc,
+                     limit=args.page_size, offset=(args.page - 1) * args.page_size)
+    total = idx.total(**filters)
+    dt = (time.perf_counter() - t0) * 1000
+    _print_rows(rows)
+    pages = max(1, -(-total // args.page_size))
+    print(f"page {args.page}/{pages}, {total} matches, {dt:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# app/tenants.py
+"""
+Несколько ботов (токен + промпт) в одном процессе.
+
+У каждого тенанта свои: Telegram Application, ChatGPTAgent (свой chats.json),
+папка студентов и пул уроков. Общие на процесс: OpenAI-клиент (пул HTTP-соединений),
+пак озвучки и TTS, общая векторка базы знаний, фоновая очередь jobs, sender, метрики.
+
+Текущий тенант хода лежит в contextvar current_tenant: его ставит хендлер тенанта,
+run_blocking копирует контекст в поток, фоновые задачи получают имя тенанта в payload.
+
+Квота тенанта (max_concurrency) — и на ходы, и на потоки: блокирующие вызовы хода
+(модель, TTS, файлы) идут через run_blocking в собственный ограниченный пул тенанта,
+так что шумный тенант не выедает общий пул asyncio.to_thread у остальных.
+Ходы одного чата выполняются строго по очереди (см. main.chat_turn).
+
+Формат TENANTS_PATH (JSON):
+  [
+    {"name": "jp", "token": "...", "prompt_path": "prompts/system_prompt.txt",
+     "chats_path": "chats_jp.json", "students_dir": "students/jp", "max_concurrency": 8}
+  ]
+prompt_path — относительно app/, students_dir — относительно корня проекта (как STUDENTS_DIR).
+"""
+import asyncio
+import contextvars
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from config import BASE_DIR, LESSON_POOL_DIR, TENANT_MAX_CONCURRENCY
+from lesson_pool import LessonPool
+from openai_client import ChatGPTAgent
+
+
+@dataclass
+class Tenant:
+    name: str
+    token: str
+    system_prompt: str
+    agent: ChatGPTAgent
+    students_dir: str
+    lesson_pool: LessonPool
+    max_concurrency: int
+    executor: ThreadPoolExecutor
+
+
+current_tenant: contextvars.ContextVar[Optional[Tenant]] = contextvars.ContextVar("current_tenant", default=None)
+
+_registry: Dict[str, Tenant] = {}
+
+
+def load_tenants(path: Path) -> List[Tenant]:
+    specs = json.loads(Path(path).read_text(encoding="utf-8"))
+    tenants: List[Tenant] = []
+    for spec in specs:
+        name = spec["name"]
+        if name in _registry:
+            raise ValueError(f"Тенант {name} описан дважды")
+        prompt_path = BASE_DIR / spec.get("prompt_path", "prompts/system_prompt.txt")
+        students_dir = spec.get("students_dir", f"students/{name}")
+        max_concurrency = int(spec.get("max_concurrency", TENANT_MAX_CONCURRENCY))
+        tenant = Tenant(
+            name=name,
+            token=spec["token"],
+            system_prompt=prompt_path.read_text(encoding="utf-8"),
+            agent=ChatGPTAgent(chats_path=spec.get("chats_path", f"./chats_{name}.json"), students_dir=students_dir),
+            students_dir=students_dir,
+            lesson_pool=LessonPool(LESSON_POOL_DIR / name),
+            max_concurrency=max_concurrency,
+            # на ход — до двух блокирующих вызовов разом: модель/файлы и синтез аудио
+            executor=ThreadPoolExecutor(max_workers=2 * max_concurrency, thread_name_prefix=f"tenant-{name}"),
+        )
+        _registry[name] = tenant
+        tenants.append(tenant)
+    return tenants
+
+
+def get_tenant(name: Optional[str]) -> Optional[Tenant]:
+    return _registry.get(name) if name else None
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Блокирующий вызов хода: в пуле потоков текущего тенанта; без тенанта — asyncio.to_thread."""
+    tenant = current_tenant.get()
+    if tenant is None:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(tenant.executor, call)
+
+
+def shutdown_executors():
+    for tenant in _registry.values():
+        tenant.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,220 @@
+# app/textproc.py
+"""
+Общая обработка текста: классы символов, разбор сценариев аудирования, очистка для TTS,
+чистка текста ученика и починка JSON ответа модели.
+
+Все шаблоны скомпилированы один раз при импорте. Тяжёлые посимвольные проходы сделаны
+через str.translate / str.find / поиск по скомпилированному шаблону, чтобы цикл шёл в C,
+а не в Python. Поведение совпадает со старыми функциями из main.py и tts.py
+(сверка — bench_text.py, там же микробенчмарк).
+
+Классы символов (classify) — один проход по тексту:
+  h — хирагана, k — катакана (включая полуширинную и ー), K — кандзи (и 々 〆),
+  l — латиница ASCII, c — кириллица, f — полноширинные ASCII-формы, s — пробельные, o — прочее.
+По строке классов clean_tts_text решает, какие проходы вообще нужны.
+"""
+import re
+from typing import Dict, List, Tuple
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Классы символов
+# ─────────────────────────────────────────────────────────────────────────────
+HIRAGANA, KATAKANA, KANJI, LATIN, CYRILLIC, FULLWIDTH, SPACE, OTHER = "hkKlcfso"
+
+_RANGES: List[Tuple[int, int, str]] = [
+    (0x3040, 0x309F, HIRAGANA),
+    (0x30A0, 0x30FF, KATAKANA),
+    (0x31F0, 0x31FF, KATAKANA),
+    (0xFF66, 0xFF9F, KATAKANA),
+    (0x3400, 0x4DBF, KANJI),
+    (0x4E00, 0x9FFF, KANJI),
+    (0xF900, 0xFAFF, KANJI),
+    (0x3005, 0x3006, KANJI),   # 々 〆
+    (0xFF01, 0xFF5E, FULLWIDTH),
+    (0x0410, 0x044F, CYRILLIC),
+]
+
+
+def _char_class(cp: int) -> str:
+    ch = chr(cp)
+    if ch.isspace():
+        return SPACE
+    if ch.isascii() and ch.isalpha():
+        return LATIN
+    if ch in "Ёё":
+        return CYRILLIC
+    for lo, hi, cls in _RANGES:
+        if lo <= cp <= hi:
+            return cls
+    return OTHER
+
+
+class _ClassTable(dict):
+    """Таблица для str.translate: код символа → класс; заполняется лениво, по встреченным символам."""
+    def __missing__(self, cp: int) -> str:
+        cls = self[cp] = _char_class(cp)
+        return cls
+
+
+_CLASS_TABLE = _ClassTable()
+
+
+def classify(text: str) -> str:
+    """Строка классов той же длины, что и text (один проход str.translate)."""
+    return text.translate(_CLASS_TABLE)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Очистка реплики для TTS
+# ─────────────────────────────────────────────────────────────────────────────
+RE_TRANSLATION = re.compile(r"\s+—\s+|\s+-\s+")
+RE_PARENS = re.compile(r"\([^)]*\)")
+RE_FW_PARENS = re.compile(r"（[^）]*）")
+RE_MULTISPACE = re.compile(r"\s{2,}")
+# латиница ASCII и базовая кириллица (как [A-Za-zА-Яа-яЁё]) — удаляются одним translate
+_DROP_LETTERS = {cp: None for cp in [*range(0x41, 0x5B), *range(0x61, 0x7B), *range(0x410, 0x450), 0x401, 0x451]}
+
+_SPEAKER_LATIN = {"А": "A", "В": "B", "С": "C", "а": "A", "в": "B", "с": "C"}
+
+
+def clean_tts_text(text: str) -> str:
+    """
+    Реплика для TTS: без перевода после « — » / « - », без скобок (в т.ч. полноширинных),
+    без латиницы и кириллицы, пробелы схлопнуты.
+    """
+    if not text:
+        return ""
+    m = RE_TRANSLATION.search(text)
+    t = text[:m.start()] if m else text
+    if "(" in t:
+        t = RE_PARENS.sub("", t)
+    if "（" in t:
+        t = RE_FW_PARENS.sub("", t)
+    # один проход classify вместо отдельных сканов: чистая японская реплика дальше не трогается
+    classes = classify(t)
+    if LATIN in classes or CYRILLIC in classes:
+        t = t.translate(_DROP_LETTERS)
+        classes = classes.replace(LATIN, "").replace(CYRILLIC, "")
+    if SPACE * 2 in classes:
+        t = RE_MULTISPACE.sub(" ", t)
+    return t.strip()
+
+
+def normalize_speaker(s: str) -> str:
+    """Метка спикера → латинская заглавная (кириллические А/В/С → A/B/C), только первый символ."""
+    if not s:
+        return ""
+    s = s.strip()
+    if not s:
+        return ""
+    return _SPEAKER_LATIN.get(s[0], s[0]).upper()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Сценарий аудирования → реплики
+# ─────────────────────────────────────────────────────────────────────────────
+RE_SPEAKER_SEP = re.compile(r"[:：]")
+
+
+def parse_script(script: str) -> List[Dict[str, str]]:
+    """
+    «A: こんにちは\\nB：元気です» → [{"speaker": "A", "jp": "こんにちは"}, ...].
+    Строка без метки (или с пустой меткой) — реплика без спикера целиком.
+    """
+    dialogue = []
+    for raw in script.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        m = RE_SPEAKER_SEP.search(line)
+        sp = line[:m.start()].rstrip() if m else ""
+        if sp:
+            dialogue.append({"speaker": sp, "jp": line[m.end():].strip()})
+        else:
+            dialogue.append({"speaker": "", "jp": line})
+    return dialogue
+
+
+def dialogue_tts_lines(dialogue: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """[(метка спикера A..Z, чистый текст для TTS), ...] — только непустые реплики."""
+    lines: List[Tuple[str, str]] = []
+    for turn in dialogue:
+        jp = (turn.get("jp") or "").strip()
+        if not jp:
+            continue
+        clean = clean_tts_text(jp)
+        if clean:
+            lines.append((normalize_speaker((turn.get("speaker") or "").strip()), clean))
+    return lines
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Текст ученика и ответ модели
+# ─────────────────────────────────────────────────────────────────────────────
+RE_FENCED_AUDIO = re.compile(r"```(?:audio|jp-audio|audio-script)\s*[\s\S]*?```", re.IGNORECASE)
+RE_SPEAKER_LINES = re.compile(r"^(?:[A-ZА-ЯЁ]{1,2}\s*:\s*.+)$", re.MULTILINE)
+RE_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def strip_dialogue(text: str) -> str:
+    """Убирает из текста ученика блоки аудио и строки реплик «A: ...»."""
+    if not text:
+        return text
+    t = RE_FENCED_AUDIO.sub("", text) if "```" in text else text
+    t = RE_SPEAKER_LINES.sub("", t)
+    return RE_BLANK_LINES.sub("\n\n", t).strip()
+
+
+RE_AUDIO_SCRIPT_BRACKET = re.compile(r'("audio_script"\s*:\s*"(?:[^"\\]|\\.)*")\s*\]\s*,', re.DOTALL)
+RE_TRAILING_COMMA = re.compile(r",\s*}")
+
+
+def repair_json(raw: str) -> str:
+    """
+    Частые ошибки формата ответа модели:
+    лишняя ] после "audio_script": "..." и висячая запятая перед }.
+    """
+    s = RE_AUDIO_SCRIPT_BRACKET.sub(r"\1,", raw) if '"audio_script"' in raw else raw
+    return RE_TRAILING_COMMA.sub("}", s)
+
+
+RE_JSON_OUTSIDE = re.compile(r'[{}"]')
+
+
+def extract_json_objects(raw: str) -> List[str]:
+    """
+    JSON-объекты верхнего уровня (строками) по балансировке фигурных скобок;
+    текст вне объектов игнорируется. Прыгает между значимыми символами вместо обхода каждого.
+    """
+    objs: List[str] = []
+    n = len(raw)
+    pos = 0
+    while True:
+        start = raw.find("{", pos)
+        if start < 0:
+            return objs
+        depth, pos = 1, start + 1
+        while depth:
+            m = RE_JSON_OUTSIDE.search(raw, pos)
+            if m is None:
+                return objs
+            ch, pos = m.group(), m.end()
+            if ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+            else:
+                # строка: до закрывающей кавычки; после \\ следующий символ пропускается целиком
+                while True:
+                    quote = raw.find('"', pos)
+                    if quote < 0:
+                        return objs
+                    esc = raw.find("\\", pos, quote)
+                    if esc < 0:
+                        pos = quote + 1
+                        break
+                    pos = esc + 2
+                    if pos > n:
+                        return objs
+        objs.append(raw[start:pos])
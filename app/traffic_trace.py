@@ -0,0 +1,96 @@
+# app/traffic_trace.py
+"""
+Запись реального трафика для нагрузочных прогонов (см. replay.py).
+
+При TRACE_CAPTURE_PATH в файл (gzip JSONL) пишутся события с относительным временем "t":
+  update          — входящее сообщение (id пользователя — HMAC с секретной солью, имён/username нет)
+  model_request   — запрос к Responses API: число сообщений, объём, число векторок
+  model_response  — сырой ответ модели и длительность вызова
+  tts             — реплика для TTS (голос, текст, формат), длительность, размер
+  stage           — длительность этапа хода (model / parse / deliver / tts / total)
+
+Текст сообщений ученика, ответы модели и реплики TTS пишутся как есть, без обезличивания:
+трейс — персональные данные, хранить и передавать его соответственно.
+
+Соль для id: TRACE_SALT из .env (стабильна между рестартами) или, если пусто, случайная
+на каждый запуск записи — она нигде не сохраняется, и хеш нельзя обратить перебором id.
+
+Ход связывается с событиями через contextvar: asyncio.to_thread копирует контекст,
+поэтому события из потоков (модель, TTS) попадают в нужный ход.
+"""
+import contextvars
+import gzip
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from config import TRACE_CAPTURE_PATH, TRACE_SALT
+import metrics
+
+
+current_turn: contextvars.ContextVar[str] = contextvars.ContextVar("current_turn", default="")
+
+
+class TraceRecorder:
+    def __init__(self, path: Path, salt: str = TRACE_SALT):
+        self._salt = (salt or secrets.token_hex(16)).encode("utf-8")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+        # каждый запуск — отдельный gzip-member: файлы можно дописывать между рестартами
+        self._fh = gzip.open(self.path, "at", encoding="utf-8")
+        self.write("session", started_at=time.time())
+
+    def write(self, ev: str, **fields):
+        rec = {"t": round(time.monotonic() - self._t0, 4), "ev": ev, "turn": current_turn.get(), **fields}
+        line = json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._fh.write(line + "\n")
+
+    def anonymize(self, user_id) -> str:
+        return hmac.new(self._salt, str(user_id).encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+    def flush(self):
+        with self._lock:
+            self._fh.flush()
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+recorder: Optional[TraceRecorder] = TraceRecorder(TRACE_CAPTURE_PATH) if TRACE_CAPTURE_PATH else None
+
+
+def record(ev: str, **fields):
+    if recorder is not None:
+        recorder.write(ev, **fields)
+
+
+def start_turn(user_id, text: str) -> str:
+    """Новый ход: id в contextvar + событие update."""
+    turn = uuid.uuid4().hex[:12]
+    current_turn.set(turn)
+    if recorder is not None:
+        recorder.write("update", user=recorder.anonymize(user_id), text=text)
+    return turn
+
+
+@contextmanager
+def stage(name: str):
+    """Длительность этапа: в metrics (stage.<name>) и, при записи, в трейс."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dur = time.perf_counter() - t0
+        metrics.observe(f"stage.{name}", dur)
+        record("stage", name=name, dur=round(dur, 4))
@@ -1,16 +1,26 @@
 from pathlib import Path
 from datetime import datetime, timezone
 from tempfile import NamedTemporaryFile
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+import io
 import os
-import re
+import subprocess
+import threading
+import time
+import uuid
 
 from pydub import AudioSegment
 from pydub.utils import which
 from contextlib import suppress
 
 from openai_client import client
-from config import OPENAI_TTS_MODEL, OPENAI_TTS_VOICE, OUT_AUDIO_DIR
+from config import OPENAI_TTS_MODEL, OPENAI_TTS_VOICE, OUT_AUDIO_DIR, TTS_OUTPUT_FORMAT, AUDIO_PACK_MAX_CHARS
+from audio_pack import get_pack
+from deadline import Deadline, breaker
+import metrics
+import traffic_trace
+import textproc
+from profiler import profiled
 
 
 
@@ -35,19 +45,18 @@ SPEAKER_VOICES: Dict[str, str] = {
 
 PAUSE_MS = 300  # пауза между репликами
 
+# формат response_format="pcm" у TTS: 24 kHz, 16 бит, моно, без заголовка
+PCM_SAMPLE_RATE = 24000
+PCM_SAMPLE_WIDTH = 2
+OPUS_BITRATE = "32k"  # для речи с запасом
+
 
 def normalize_speaker_label(s: str) -> str:
     """
     Приводит метку спикера к латинской A..Z (учитывая кириллицу А/В/С и т.п.),
     берёт только первый символ.
     """
-    if not s:
-        return ""
-    s = s.strip()
-    # заменим кириллические аналоги на латиницу для A/B/C
-    repl = {"А": "A", "В": "B", "С": "C", "а": "A", "в": "B", "с": "C"}
-    c = repl.get(s[0], s[0])
-    return c.upper()
+    return textproc.normalize_speaker(s)
 
 
 def _pick_voice_for_speaker(speaker: str) -> str:
@@ -55,6 +64,7 @@ def _pick_voice_for_speaker(speaker: str) -> str:
     return SPEAKER_VOICES.get(key, OPENAI_TTS_VOICE)
 
 
+@profiled("prepare_tts_text")
 def prepare_tts_text(text: str) -> str:
     """
     Очищает реплику для TTS:
@@ -63,64 +73,192 @@ def prepare_tts_text(text: str) -> str:
     - удаляет латиницу и кириллицу (оставляя японский текст)
     - схлопывает пробелы
     """
-    if not text:
-        return ""
-    t = text
-    t = re.split(r"\s+—\s+|\s+-\s+", t, maxsplit=1)[0]
-    # удалим ( ... ) и （ ... ）
-    t = re.sub(r"\([^)]*\)", "", t)
-    t = re.sub(r"（[^）]*）", "", t)
-    t = re.sub(r"[A-Za-zА-Яа-яЁё]", "", t)
-    t = re.sub(r"\s{2,}", " ", t).strip()
-    return t
+    return textproc.clean_tts_text(text)
+
+
+@profiled("tts_lines")
+def _iter_tts_lines(dialogue: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """[(voice, clean_text), ...] — только непустые реплики, без меток спикеров."""
+    return [
+        (SPEAKER_VOICES.get(label, OPENAI_TTS_VOICE), clean_text)
+        for label, clean_text in textproc.dialogue_tts_lines(dialogue)  # <- без "A:" / "B:" и без перевода/скобок
+    ]
+
+
+def _speech_bytes(voice: str, text: str, fmt: str, timeout: Optional[float] = None) -> bytes:
+    # под бюджетом хода ретраи SDK (max_retries=2) растянули бы вызов втрое — таймаут и есть весь остаток
+    api = client.with_options(timeout=timeout, max_retries=0) if timeout is not None else client
+    resp = api.audio.speech.create(
+        model=OPENAI_TTS_MODEL,
+        voice=voice,
+        input=text,
+        response_format=fmt,
+    )
+    return resp.read()
 
 
-def synth_dialogue_to_mp3(dialogue: List[Dict[str, str]]) -> Path:
+def _live_line_audio(voice: str, text: str, fmt: str, deadline: Optional[Deadline]) -> bytes:
+    tts_breaker = breaker("tts")
+    if not tts_breaker.allow():
+        raise RuntimeError("TTS временно недоступен")
+    timeout = None
+    if deadline is not None:
+        deadline.check("tts")
+        timeout = deadline.timeout()
+    t0 = time.perf_counter()
+    try:
+        data = _speech_bytes(voice, text, fmt, timeout=timeout)
+    except Exception:
+        tts_breaker.record_failure()
+        raise
+    tts_breaker.record_success()
+    traffic_trace.record("tts", voice=voice, text=text, fmt=fmt,
+                         dur=round(time.perf_counter() - t0, 4), bytes=len(data))
+    return data
+
+
+def _line_audio(voice: str, text: str, fmt: str, deadline: Optional[Deadline] = None) -> bytes:
+    """Короткие реплики (слова из словаря Wasabi) — из предсобранного пака, остальное — живой TTS."""
+    if len(text) <= AUDIO_PACK_MAX_CHARS:
+        data = get_pack(fmt).get(voice, text)
+        if data is not None:
+            metrics.incr("tts.pack_hit")
+            return data
+    metrics.incr("tts.live")
+    return _live_line_audio(voice, text, fmt, deadline)
+
+
+def fetch_dialogue_audio(dialogue: List[Dict[str, str]], fmt: str, deadline: Optional[Deadline] = None) -> List[bytes]:
     """
-    Для каждой реплики выбираем голос по метке спикера,
-    но в TTS отправляем ТОЛЬКО японский текст без метки.
+    Озвучивает реплики по одной в формате fmt ("mp3" | "opus" | "pcm").
+    С deadline каждая реплика получает таймаут по остатку бюджета; бюджет кончился — DeadlineExceeded.
     """
+    return [_line_audio(voice, text, fmt, deadline) for voice, text in _iter_tts_lines(dialogue)]
+
+
+def _out_path(suffix: str) -> Path:
+    ts = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S_%f")
+    return OUT_AUDIO_DIR / f"jlpt_dialog_{ts}.{suffix}"
+
+
+def _run_ffmpeg(args: List[str], stdin: Optional[bytes] = None):
+    proc = subprocess.run(
+        [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y", *args],
+        input=stdin,
+        capture_output=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {proc.stderr.decode('utf-8', 'replace').strip()}")
 
-    ts = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-    out_path = OUT_AUDIO_DIR / f"jlpt_dialog_{ts}.mp3"
 
+@profiled("audio_assembly")
+def assemble_mp3(chunks: List[bytes]) -> Path:
+    out_path = _out_path("mp3")
     merged = AudioSegment.silent(duration=0)
     silence = AudioSegment.silent(duration=PAUSE_MS)
-    temp_files: List[str] = []
+    for data in chunks:
+        merged += AudioSegment.from_file(io.BytesIO(data), format="mp3") + silence
+    merged.export(out_path, format="mp3")
+    return out_path
 
-    try:
-        for turn in dialogue:
-            sp = (turn.get("speaker") or "").strip()
-            jp = (turn.get("jp") or "").strip()
-            if not jp:
-                continue
-
-            voice = _pick_voice_for_speaker(sp)
-            clean_text = prepare_tts_text(jp)  # <- без "A:" / "B:" и без перевода/скобок
-            if not clean_text:
-                continue
-
-            with NamedTemporaryFile(delete=False, suffix=".mp3") as tf:
-                tmp_path = tf.name
+
+@profiled("audio_assembly")
+def assemble_ogg_from_pcm(chunks: List[bytes]) -> Path:
+    """
+    Сырые PCM склеиваются простой конкатенацией байтов (паузы — нули),
+    затем ОДИН проход libopus в OGG.
+    """
+    out_path = _out_path("ogg")
+    silence = b"\x00" * (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH * PAUSE_MS // 1000)
+    pcm = silence.join(chunks) + silence
+    _run_ffmpeg(
+        ["-f", "s16le", "-ar", str(PCM_SAMPLE_RATE), "-ac", "1", "-i", "pipe:0",
+         "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip", str(out_path)],
+        stdin=pcm,
+    )
+    return out_path
+
+
+_silence_lock = threading.Lock()
+
+
+def _opus_silence_file() -> Path:
+    """
+    Пауза между репликами, закодированная в Opus один раз и переиспользуемая.
+    Диалоги синтезируются параллельно в потоках: файл строится под замком во временное имя
+    и появляется целиком через os.replace — недописанную паузу никто не склеит.
+    """
+    p = OUT_AUDIO_DIR / f"_silence_{PAUSE_MS}ms.ogg"
+    if p.exists():
+        return p
+    with _silence_lock:
+        if not p.exists():
+            silence = b"\x00" * (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH * PAUSE_MS // 1000)
+            tmp = p.with_name(f"{p.stem}.{uuid.uuid4().hex}.ogg")  # другой процесс не столкнётся
             try:
-                resp = client.audio.speech.create(
-                    model=OPENAI_TTS_MODEL,
-                    voice=voice,
-                    input=clean_text
+                _run_ffmpeg(
+                    ["-f", "s16le", "-ar", str(PCM_SAMPLE_RATE), "-ac", "1", "-i", "pipe:0",
+                     "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip", str(tmp)],
+                    stdin=silence,
                 )
-                resp.write_to_file(tmp_path)
-                temp_files.append(tmp_path)
+                os.replace(tmp, p)
+            finally:
+                with suppress(FileNotFoundError):
+                    os.remove(tmp)
+    return p
 
-                seg = AudioSegment.from_file(tmp_path, format="mp3")
-                merged += seg + silence
-            except Exception:
-                with suppress(Exception):
-                    os.remove(tmp_path)
-                raise
 
-        merged.export(out_path, format="mp3")
+@profiled("audio_assembly")
+def assemble_ogg_from_opus(chunks: List[bytes]) -> Path:
+    """
+    Готовые OGG/Opus реплики склеиваются ремуксом (concat demuxer, -c copy) — без перекодирования.
+    """
+    out_path = _out_path("ogg")
+    silence = _opus_silence_file()
+    temp_files: List[str] = []
+    try:
+        entries: List[str] = []
+        for data in chunks:
+            with NamedTemporaryFile(delete=False, suffix=".ogg") as tf:
+                tf.write(data)
+                temp_files.append(tf.name)
+            entries += [tf.name, str(silence)]
+        with NamedTemporaryFile("w", delete=False, suffix=".txt", encoding="utf-8") as lf:
+            lf.write("".join(f"file '{e}'\n" for e in entries))
+            temp_files.append(lf.name)
+        _run_ffmpeg(["-f", "concat", "-safe", "0", "-i", lf.name, "-c", "copy", str(out_path)])
         return out_path
     finally:
         for p in temp_files:
             with suppress(Exception):
                 os.remove(p)
+
+
+def synth_dialogue_to_mp3(dialogue: List[Dict[str, str]], deadline: Optional[Deadline] = None) -> Path:
+    """
+    Для каждой реплики выбираем голос по метке спикера,
+    но в TTS отправляем ТОЛЬКО японский текст без метки.
+    """
+    return assemble_mp3(fetch_dialogue_audio(dialogue, "mp3", deadline))
+
+
+def synth_dialogue_to_ogg(dialogue: List[Dict[str, str]], source: str = "pcm", deadline: Optional[Deadline] = None) -> Path:
+    """
+    OGG/Opus для голосового сообщения Telegram.
+    source="pcm"  — TTS отдаёт сырой PCM, кодируем в Opus один раз;
+    source="opus" — TTS отдаёт Opus, склеиваем ремуксом без перекодирования.
+    """
+    chunks = fetch_dialogue_audio(dialogue, source, deadline)
+    if source == "opus":
+        return assemble_ogg_from_opus(chunks)
+    return assemble_ogg_from_pcm(chunks)
+
+
+def synth_dialogue(dialogue: List[Dict[str, str]], fmt: str = TTS_OUTPUT_FORMAT, deadline: Optional[Deadline] = None) -> Path:
+    """
+    Точка входа для бота: формат берётся из TTS_OUTPUT_FORMAT.
+    .mp3 — отправлять как audio, .ogg — как voice.
+    """
+    if fmt in ("opus", "pcm"):
+        return synth_dialogue_to_ogg(dialogue, source=fmt, deadline=deadline)
+    return synth_dialogue_to_mp3(dialogue, deadline=deadline)
@@ -0,0 +1,218 @@
+"""
+Webhook-режим: асинхронный HTTP-фронт перед Telegram Application.
+
+Сервер принимает апдейты от Telegram (POST на WEBHOOK_PATH), проверяет
+секрет из заголовка X-Telegram-Bot-Api-Secret-Token и кладёт апдейт
+в application.update_queue — дальше его разбирают те же хендлеры, что и в polling.
+С публичным WEBHOOK_URL секрет обязателен (без него сервер не стартует);
+без секрета апдейты принимаются только в локальном режиме (WEBHOOK_URL пуст).
+Несколько ботов (tenants.py) обслуживаются одним сервером: у каждого свой путь
+WEBHOOK_PATH/<имя тенанта>.
+
+  GET /health — процесс жив, глубина очереди
+  GET /ready  — готовность принимать трафик (503, если очередь переполнена)
+
+Локальная проверка без Telegram:
+  python webhook.py post recorded_updates.jsonl --url http://127.0.0.1:8080/telegram --secret XXX
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import signal
+from contextlib import suppress
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web, ClientSession
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+from deadline import breaker_states
+from config import (
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_QUEUE,
+)
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(
+        self,
+        routes: Dict[str, Application],
+        secret_token: str = WEBHOOK_SECRET_TOKEN,
+        max_queue: int = WEBHOOK_MAX_QUEUE,
+    ):
+        self.routes = routes
+        self.secret_token = secret_token
+        self.max_queue = max_queue
+        self.accepted = 0
+        self.rejected = 0
+
+        self.web_app = web.Application()
+        for path in routes:
+            self.web_app.router.add_post(path, self.handle_update)
+        self.web_app.router.add_get("/health", self.handle_health)
+        self.web_app.router.add_get("/ready", self.handle_ready)
+        self._runner: Optional[web.AppRunner] = None
+
+    def queue_depth(self) -> int:
+        return sum(app.update_queue.qsize() for app in self.routes.values())
+
+    def _secret_ok(self, request: web.Request) -> bool:
+        if not self.secret_token:
+            return True
+        got = request.headers.get(SECRET_HEADER, "")
+        return hmac.compare_digest(got, self.secret_token)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not self._secret_ok(request):
+            self.rejected += 1
+            return web.Response(status=403)
+        application = self.routes[request.path]
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            self.rejected += 1
+            print(f"[webhook] bad update: {e}")
+            return web.Response(status=400)
+        if update is None:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        # отвечаем Telegram сразу, обработка идёт из очереди
+        await application.update_queue.put(update)
+        self.accepted += 1
+        return web.Response(status=200)
+
+    def _status(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_queue": self.max_queue,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "running": all(app.running for app in self.routes.values()),
+        }
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            **self._status(),
+            "breakers": breaker_states(),
+            "metrics": metrics.snapshot(),
+        })
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        st = self._status()
+        ready = st["running"] and st["queue_depth"] < self.max_queue
+        return web.json_response(
+            {"status": "ready" if ready else "busy", **st},
+            status=200 if ready else 503,
+        )
+
+    async def start(self, host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT):
+        self._runner = web.AppRunner(self.web_app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        for path in self.routes:
+            print(f"[webhook] listening on http://{host}:{port}{path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve_webhook(routes: Dict[str, Tuple[Application, str]]):
+    """
+    Жизненный цикл Application без run_polling: initialize → start → HTTP-сервер,
+    до SIGINT/SIGTERM. post_init/post_stop/post_shutdown вызываются так же, как в run_polling.
+
+    routes: путь на нашем сервере → (Application, публичный URL для setWebhook или "").
+    """
+    if not WEBHOOK_SECRET_TOKEN and any(url for _, url in routes.values()):
+        # иначе любой, кто знает путь, может слать боту поддельные апдейты
+        raise RuntimeError("WEBHOOK_URL задан, а WEBHOOK_SECRET_TOKEN пуст: публичный webhook без секрета не запускаем")
+    if not WEBHOOK_SECRET_TOKEN:
+        print("[webhook] WARNING: no WEBHOOK_SECRET_TOKEN, accepting unsigned updates (local mode only)")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    server = WebhookServer({path: app for path, (app, _) in routes.items()})
+    started = []
+    try:
+        for path, (application, url) in routes.items():
+            await application.initialize()
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            started.append(application)
+            if url:
+                await application.bot.set_webhook(
+                    url=url,
+                    secret_token=WEBHOOK_SECRET_TOKEN,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+                print(f"[webhook] setWebhook -> {url}")
+            else:
+                print(f"[webhook] no public URL for {path}: local mode, setWebhook skipped")
+        await server.start()
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        for application in started:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# CLI: прогон записанных апдейтов через локальный сервер
+# ─────────────────────────────────────────────────────────────────────────────
+async def post_recorded_updates(path: Path, url: str, secret: str, delay: float = 0.0):
+    """
+    Шлёт апдейты из файла (JSONL — по апдейту в строке, или JSON-массив) на url.
+    """
+    raw = path.read_text(encoding="utf-8").strip()
+    if raw.startswith("["):
+        updates = json.loads(raw)
+    else:
+        updates = [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+    headers = {SECRET_HEADER: secret} if secret else {}
+    async with ClientSession() as session:
+        for upd in updates:
+            async with session.post(url, json=upd, headers=headers) as resp:
+                print(f"update_id={upd.get('update_id')} -> {resp.status}")
+            if delay:
+                await asyncio.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook helpers")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_post = sub.add_parser("post", help="POST записанных апдейтов на локальный webhook")
+    p_post.add_argument("file", type=Path)
+    p_post.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    p_post.add_argument("--secret", default=WEBHOOK_SECRET_TOKEN)
+    p_post.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.cmd == "post":
+        asyncio.run(post_recorded_updates(args.file, args.url, args.secret, args.delay))
+
+
+if __name__ == "__main__":
+    main()